@@ -3,7 +3,13 @@
 import math
 import os
 import time
+from array import array
+from bisect import bisect_left
 from collections import Counter
+from collections.abc import Mapping
+
+import distance
+import lecture
 
 
 def compter_occurences(mots):
@@ -36,48 +42,197 @@ def _get_mots(comment):
     return comment.strip().split()
 
 
+def _dates_fichiers(dossier):
+    """Renvoie la date de modification de chaque fichier d'un dossier."""
+    with os.scandir(dossier) as entrees:
+        return {entree.name: entree.stat().st_mtime_ns for entree in entrees}
+
+
 def get_mots_film(id_film, dossier):
     """Renvoie les mots des commentaire d'un film dans le dossier."""
     commentaire = _get_comments(id_film, dossier)
     return _get_mots(commentaire)
 
 
+class Vocabulaire:
+    """Associe à chaque mot un identifiant entier, dans l'ordre d'arrivée."""
+
+    def __init__(self):
+        """Initialise la table mot -> identifiant et sa réciproque."""
+        self.identifiants = {}
+        self.mots = []
+
+    def __len__(self):
+        return len(self.mots)
+
+    def identifiant(self, mot):
+        """Renvoie l'identifiant du mot, en l'ajoutant s'il est nouveau."""
+        ident = self.identifiants.get(mot)
+        if ident is None:
+            ident = len(self.mots)
+            self.identifiants[mot] = ident
+            self.mots.append(mot)
+        return ident
+
+
+class VecteurIdentifiants(Mapping):
+    """Base des vecteurs creux indexés par les identifiants triés des mots.
+
+    Les sous-classes définissent les attributs `vocabulaire` et `ids`.
+    """
+
+    __slots__ = ()
+
+    def _rang(self, mot):
+        """Renvoie la position du mot dans `ids`, -1 s'il est absent."""
+        ident = self.vocabulaire.identifiants.get(mot)
+        if ident is None:
+            return -1
+        rang = bisect_left(self.ids, ident)
+        if rang < len(self.ids) and self.ids[rang] == ident:
+            return rang
+        return -1
+
+    def __iter__(self):
+        mots = self.vocabulaire.mots
+        return (mots[ident] for ident in self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class CompteFilm(VecteurIdentifiants):
+    """Compte des mots d'un film, stocké dans deux tableaux d'entiers.
+
+    Les identifiants des mots sont triés pour permettre une recherche
+    dichotomique. Comme un Counter, renvoie 0 pour un mot absent.
+    """
+
+    __slots__ = ("vocabulaire", "ids", "comptes")
+
+    def __init__(self, vocabulaire, compte):
+        """Convertit un dictionnaire mot -> occurences.
+
+        :param vocabulaire: objet Vocabulaire partagé par tous les films.
+        """
+        self.vocabulaire = vocabulaire
+        identifiant = vocabulaire.identifiant
+        par_id = {identifiant(mot): nb for mot, nb in compte.items()}
+        ids = sorted(par_id)
+        self.ids = array('I', ids)
+        self.comptes = array('I', map(par_id.__getitem__, ids))
+
+    def __getitem__(self, mot):
+        rang = self._rang(mot)
+        return self.comptes[rang] if rang >= 0 else 0
+
+    def __contains__(self, mot):
+        return self._rang(mot) >= 0
+
+    def get(self, mot, defaut=None):
+        rang = self._rang(mot)
+        return self.comptes[rang] if rang >= 0 else defaut
+
+    def items(self):
+        mots = self.vocabulaire.mots
+        return zip((mots[ident] for ident in self.ids), self.comptes)
+
+
+class ComptesMots(Mapping):
+    """Vue mot -> valeur d'un tableau indexé par identifiant de mot.
+
+    Renvoie 0 pour un mot inconnu, et ne liste que les valeurs non nulles.
+    """
+
+    def __init__(self, vocabulaire, valeurs):
+        """:param valeurs: tableau indexé par les identifiants des mots."""
+        self.vocabulaire = vocabulaire
+        self.valeurs = valeurs
+
+    def __getitem__(self, mot):
+        ident = self.vocabulaire.identifiants.get(mot)
+        return self.valeurs[ident] if ident is not None else 0
+
+    def __contains__(self, mot):
+        return self[mot] > 0
+
+    def __iter__(self):
+        mots = self.vocabulaire.mots
+        return (mots[ident] for ident, valeur in enumerate(self.valeurs)
+                if valeur > 0)
+
+    def __len__(self):
+        return sum(1 for valeur in self.valeurs if valeur > 0)
+
+
 class StockeurFrequences:
     """Conserve pour chaque film son compte de mots."""
 
     def __init__(self):
         """Initialise le stockeur.
 
-        :occurences: dictionnaire qui associe à un film l'objet
-        collections.Counter de ses commentaires.
+        Les mots sont remplacés par un identifiant entier commun à tous les
+        films, et les comptes sont stockés dans des tableaux d'entiers.
+
+        :occurences: dictionnaire qui associe à un film l'objet CompteFilm
+        de ses commentaires.
         occurences: film_id -> dictionnaire: mot -> occurences dans le texte
-        :nb_apparitions_uniques: compte le nombre de films dans lesquels chaque
-                                 mot apparaît
-        :total: stocke le compte parmi tous les textes ensembles
+        :apparitions: compte le nombre de films dans lesquels chaque mot
+                      apparaît, indexé par identifiant
+        :comptes_total: stocke le compte parmi tous les textes ensembles,
+                        indexé par identifiant
         """
+        self.vocabulaire = Vocabulaire()
         self.occurences = {}
-        self.total = Counter()
-        self.nb_apparitions_uniques = Counter()
+        self.comptes_total = array('Q')
+        self.apparitions = array('I')
         self.nb_films = 0
+        self.total = ComptesMots(self.vocabulaire, self.comptes_total)
+        self.nb_apparitions_uniques = ComptesMots(self.vocabulaire,
+                                                  self.apparitions)
 
     def compter_tous_films(self, dossier):
         """Ajoute un film et son compte de mots dans la base.
 
         :param dossier: dossier où chercher les fichiers des films.
         """
-        for film_id in os.listdir(dossier):
-            mots = get_mots_film(film_id, dossier)
-            compte = compter_occurences(mots)
+        # Les fichiers sont lus à l'avance pendant le comptage
+        for film_id, contenu in lecture.lire_fichiers(dossier,
+                                                      os.listdir(dossier)):
+            self.ajouter_film(film_id, compter_occurences(_get_mots(contenu)))
 
-            self.occurences[film_id] = compte
-            for mot in compte.keys():
-                self.nb_apparitions_uniques[mot] += 1
-            # update ajoute le compte au total (sans créer de nouveau Counter)
-            self.total.update(compte)
-            self.nb_films += 1
+    def ajouter_film(self, film_id, compte):
+        """Ajoute le compte de mots d'un film, en remplaçant l'ancien.
+
+        :param compte: dictionnaire mot -> occurences, par exemple un objet
+                       collections.Counter.
+        """
+        if film_id in self.occurences:
+            self.retirer_film(film_id)
+        compte_film = CompteFilm(self.vocabulaire, compte)
+        # Agrandit les tableaux pour les mots nouveaux
+        manquants = len(self.vocabulaire) - len(self.apparitions)
+        if manquants > 0:
+            self.apparitions.extend(array('I', [0]) * manquants)
+            self.comptes_total.extend(array('Q', [0]) * manquants)
+        self.occurences[film_id] = compte_film
+        for ident, nb in zip(compte_film.ids, compte_film.comptes):
+            self.apparitions[ident] += 1
+            self.comptes_total[ident] += nb
+        self.nb_films += 1
+
+    def retirer_film(self, film_id):
+        """Retire un film de la base et renvoie son compte de mots."""
+        compte = self.get_compte_film(film_id)
+        del self.occurences[film_id]
+        for ident, nb in zip(compte.ids, compte.comptes):
+            self.apparitions[ident] -= 1
+            self.comptes_total[ident] -= nb
+        self.nb_films -= 1
+        return compte
 
     def get_compte_film(self, film_id):
-        """Renvoie l'objet Counter associé à un film."""
+        """Renvoie l'objet CompteFilm associé à un film."""
         if film_id in self.occurences:
             return self.occurences[film_id]
         raise ValueError("Film %s pas compté." % film_id)
@@ -103,12 +258,30 @@ class StockeurFrequences:
         return self.nb_apparitions_uniques
 
 
+def _tf(nb_occurences, nb_mots):
+    return math.log(nb_occurences) / nb_mots
+
+
+def indices_tf_film(compte):
+    """Renvoie les indices TF d'un film dans un tableau de flottants.
+
+    :param compte: objet CompteFilm, le tableau suit l'ordre de ses
+                   identifiants de mots.
+    """
+    nb_mots = len(compte)
+    return array('d', [_tf(nb, nb_mots) for nb in compte.comptes])
+
+
 class CalculateurIndices:
     """Calcule l'indice TF-IDF des mots."""
 
     def __init__(self):
         """Initialise un dctionnaire pour stocker les indices IDF."""
         self.indices_idf = {}
+        # Nombre de films du corpus quand les indices IDF ont été calculés
+        self.nb_films_idf = None
+        # Mots dont le nombre de films a changé depuis leur calcul
+        self.a_recalculer = set()
 
     def indice_tf(self, mot, occurences_texte):
         """Renvoie l'indice TF d'un mot dans un texte.
@@ -119,7 +292,7 @@ class CalculateurIndices:
         :param occurences_texte: 'Counter' des occurences de chaque mot du
                                  texte.
         """
-        return math.log(occurences_texte[mot]) / len(occurences_texte.keys())
+        return _tf(occurences_texte[mot], len(occurences_texte.keys()))
 
     def indice_idf(self, mot, apparitions_uniques, nb_films):
         """Calcule l'indice IDF d'un mot dans un corpus.
@@ -131,13 +304,47 @@ class CalculateurIndices:
         :param occurences_total: Dictionnaire des 'Counter' de tous les textes
                                  du corpus.
         """
+        self._decaler(nb_films)
         if mot in self.indices_idf:
             return self.indices_idf[mot]
+        self.a_recalculer.discard(mot)
         apparu = apparitions_uniques[mot]
         idf = math.log10(nb_films / apparu)
         self.indices_idf[mot] = idf
         return idf
 
+    def _decaler(self, nb_films):
+        """Met à jour les indices IDF en cache si le corpus a changé de taille.
+
+        log(N'/n) = log(N/n) + log(N'/N): un seul décalage pour tous les mots,
+        sans relire leur nombre d'apparitions.
+        """
+        if nb_films == 0:
+            # Corpus vide: aucun mot n'a d'indice, on repartira de zéro
+            self.indices_idf.clear()
+            self.nb_films_idf = None
+        elif self.nb_films_idf is None:
+            self.nb_films_idf = nb_films
+        elif nb_films != self.nb_films_idf:
+            decalage = math.log10(nb_films / self.nb_films_idf)
+            for mot in self.indices_idf:
+                self.indices_idf[mot] += decalage
+            self.nb_films_idf = nb_films
+
+    def invalider(self, mots):
+        """Oublie l'indice IDF des mots dont le nombre de films a changé."""
+        for mot in mots:
+            self.indices_idf.pop(mot, None)
+            self.a_recalculer.add(mot)
+
+    def actualiser(self, apparitions_uniques, nb_films):
+        """Recalcule les indices IDF invalidés des mots encore présents."""
+        self._decaler(nb_films)
+        for mot in list(self.a_recalculer):
+            if apparitions_uniques[mot] > 0:
+                self.indice_idf(mot, apparitions_uniques, nb_films)
+        self.a_recalculer.clear()
+
     def indice_tfidf(self, mot, film, stockeur_frequences):
         """Indice TF-IDF d'un mot d'un texte par rapport au corpus.
 
@@ -167,9 +374,13 @@ def filtrer_dictionnaire_mots(mots_pertinents, dictionnaire):
 
 
 class StockeurIndicesTfIdf:
-    """Pour chaque film, enregistre l'indice TF-IDF de chaque mot."""
+    """Pour chaque film, enregistre l'indice TF de chaque mot.
 
-    def __init__(self, dossier, prop_min, prop_max):
+    L'IDF est appliqué à la lecture: ajouter ou retirer un film ne
+    recalcule que ses propres indices TF et l'IDF des mots qu'il contient.
+    """
+
+    def __init__(self, dossier, prop_min, prop_max, stockeur_freq=None):
         """Initialise le stockeur des indices TF-IDF.
 
         Par défaut, calcule tous les indices TF-IDF des mots.
@@ -177,56 +388,166 @@ class StockeurIndicesTfIdf:
         :param dossier: dossier contenant les fichiers des films.
         :param occ_min: nombre minimal de films où doit apparaitre un mot pour
                         etre pris en compte dans le k-means.
+        :param stockeur_freq: objet StockeurFrequences déjà rempli, le
+                              comptage est alors sauté.
         """
-        self.stockeur_freq = StockeurFrequences()
+        self.stockeur_freq = stockeur_freq or StockeurFrequences()
         self.calculateur = CalculateurIndices()
-        """ Indices_tf_idf est un dictionnaire de dictionnaires:
-        film -> dictionnaire: mot -> indice_tf_idf
-        ou matrice[film][mot]
-        """
-        self.indices_tf_idf = {}
+        # film -> tableau des indices TF, dans l'ordre des identifiants de
+        # son objet CompteFilm
+        self.indices_tf = {}
         self.indices_tf_idf_filtres = {}
-
-        print("Compte des occurences de chaque mot.")
-        debut = time.time()
-        self.stockeur_freq.compter_tous_films(dossier)
-        print("Comptage terminé en %.3fs." % (time.time() - debut))
+        # mot -> plus grand indice TF parmi les films, et mots dont un film
+        # a été retiré, pour lesquels il faut le rechercher
+        self.max_tf = {}
+        self.max_tf_a_recalculer = set()
+        # film -> date de modification du fichier compté, en nanosecondes
+        self.dates_films = {}
+        self.prop_min = prop_min
+        self.prop_max = prop_max
+
+        if stockeur_freq is None:
+            print("Compte des occurences de chaque mot.")
+            debut = time.time()
+            self.stockeur_freq.compter_tous_films(dossier)
+            print("Comptage terminé en %.3fs." % (time.time() - debut))
+        if os.path.isdir(dossier):
+            self.dates_films = {film: date for film, date in
+                                _dates_fichiers(dossier).items()
+                                if film in self.stockeur_freq.occurences}
 
         print("%d films" % self.stockeur_freq.get_nb_films_total())
-        self.occ_min = int(prop_min * self.stockeur_freq.get_nb_films_total())
-        self.occ_max = int(prop_max * self.stockeur_freq.get_nb_films_total())
+        self._calculer_seuils()
         print("Occurences minimum: %d\tOccurences maximum: %d" %
               (self.occ_min, self.occ_max))
 
         print("Calcul des indices TF-IDF")
         debut = time.time()
-        for film, occ_film in self.stockeur_freq.occurences.items():
-            self.indices_tf_idf[film] = {}
-            for mot in occ_film.keys():
-                self.indices_tf_idf[film][mot] = self.calculateur.indice_tfidf(
-                    mot, film, self.stockeur_freq)
+        for film in self.stockeur_freq.occurences.keys():
+            self._calculer_film(film)
+        apparitions = self.stockeur_freq.get_apparitions_uniques()
+        nb_films = self.stockeur_freq.get_nb_films_total()
+        for mot in apparitions:
+            self.calculateur.indice_idf(mot, apparitions, nb_films)
         print("Calcul des indices effectué en %.3fs." % (time.time() - debut))
 
+    def _calculer_seuils(self):
+        nb_films = self.stockeur_freq.get_nb_films_total()
+        self.occ_min = int(self.prop_min * nb_films)
+        self.occ_max = int(self.prop_max * nb_films)
+
+    def _calculer_film(self, film):
+        """Calcule les indices TF de tous les mots d'un film."""
+        compte = self.stockeur_freq.get_compte_film(film)
+        indices = indices_tf_film(compte)
+        self.indices_tf[film] = indices
+        mots = self.stockeur_freq.vocabulaire.mots
+        for ident, indice in zip(compte.ids, indices):
+            mot = mots[ident]
+            if indice > self.max_tf.get(mot, -math.inf):
+                self.max_tf[mot] = indice
+
+    def _apres_modification(self, mots):
+        """Invalide ce qui dépend du corpus après l'ajout ou le retrait."""
+        self.calculateur.invalider(mots)
+        self._calculer_seuils()
+        self.indices_tf_idf_filtres.clear()
+        distance.StockeurDistances.distances.clear()
+
+    def ajouter_film(self, film_id, compte):
+        """Ajoute ou remplace un film sans recompter le reste du corpus.
+
+        Seuls les indices TF du film et l'IDF de ses mots sont recalculés.
+
+        :param compte: objet collections.Counter des mots du film.
+        """
+        if film_id in self.stockeur_freq.occurences:
+            self.retirer_film(film_id)
+        self.stockeur_freq.ajouter_film(film_id, compte)
+        self._apres_modification(compte.keys())
+        self._calculer_film(film_id)
+
+    def ajouter_film_fichier(self, film_id, dossier):
+        """Ajoute un film à partir de son fichier dans le dossier."""
+        date = os.stat(os.path.join(dossier, film_id)).st_mtime_ns
+        self.ajouter_film(film_id, compter_occurences(
+            get_mots_film(film_id, dossier)))
+        self.dates_films[film_id] = date
+
+    def retirer_film(self, film_id):
+        """Retire un film du corpus."""
+        compte = self.stockeur_freq.retirer_film(film_id)
+        del self.indices_tf[film_id]
+        self.dates_films.pop(film_id, None)
+        self.max_tf_a_recalculer.update(compte.keys())
+        self._apres_modification(compte.keys())
+
+    def films_modifies(self, dossier):
+        """Compare le dossier des films à ce qui a été compté.
+
+        Seules les dates de modification des fichiers sont lues.
+        Renvoie (films ajoutés ou modifiés, films retirés).
+        """
+        dates = _dates_fichiers(dossier)
+        modifies = [film for film, date in dates.items()
+                    if self.dates_films.get(film) != date]
+        retires = [film for film in self.indices_tf if film not in dates]
+        return modifies, retires
+
+    def get_films(self):
+        """Renvoie les identifiants des films du corpus."""
+        return self.indices_tf.keys()
+
     def get_idf_mot(self, mot):
         """Renvoie l'indice IDF d'un mot donné."""
-        return self.calculateur.indices_idf.get(mot, 0)
+        return self.get_tous_idf().get(mot, 0)
 
     def get_tous_idf(self):
         """Renvoie le dictionnaire des indices IDF de tous les mots."""
+        self.calculateur.actualiser(
+            self.stockeur_freq.get_apparitions_uniques(),
+            self.stockeur_freq.get_nb_films_total())
         return self.calculateur.indices_idf
 
     def get_tf_idf(self, mot, film):
         """Renvoie l'indice TF-IDF d'un mot pour un film donné."""
-        return self.indices_tf_idf[film].get(mot, 0)
+        rang = self.stockeur_freq.get_compte_film(film)._rang(mot)
+        if rang < 0:
+            return 0
+        return self.indices_tf[film][rang] * self.get_idf_mot(mot)
 
     def get_tf_idf_film(self, film):
         """Renvoie le dictionnaire des indices TF-IDF du film."""
-        return self.indices_tf_idf[film]
+        return self.calculer_indices_tfidf_mots_filtres(film, None)
+
+    def _actualiser_max_tf(self):
+        """Recherche le plus grand TF des mots dont un film a été retiré.
+
+        Un seul parcours du corpus pour tous les retraits depuis la
+        dernière lecture.
+        """
+        if not self.max_tf_a_recalculer:
+            return
+        a_recalculer = self.max_tf_a_recalculer
+        for mot in a_recalculer:
+            self.max_tf.pop(mot, None)
+        mots = self.stockeur_freq.vocabulaire.mots
+        for film, indices in self.indices_tf.items():
+            compte = self.stockeur_freq.get_compte_film(film)
+            for ident, indice in zip(compte.ids, indices):
+                mot = mots[ident]
+                if mot in a_recalculer and \
+                        indice > self.max_tf.get(mot, -math.inf):
+                    self.max_tf[mot] = indice
+        self.max_tf_a_recalculer = set()
 
     def get_max_tf_idf(self, mot):
-        """Renvoie le max des indices TF-IDF d'un mot pour tous les films."""
-        liste_des_films = self.stockeur_freq.occurences.keys()
-        return max([self.get_tf_idf(mot, film) for film in liste_des_films])
+        """Renvoie le max des indices TF-IDF d'un mot pour tous les films.
+
+        L'IDF est positif: c'est le plus grand TF multiplié par l'IDF.
+        """
+        self._actualiser_max_tf()
+        return self.max_tf.get(mot, 0.0) * self.get_idf_mot(mot)
 
     def get_stockeur_frequences(self):
         """Renvoie le stockeur de fréquences brutes."""
@@ -245,16 +566,65 @@ class StockeurIndicesTfIdf:
             print("%s" % mot, end=", ")
         return not(trop_peu or trop_bcp)
 
+    def calculer_indices_tfidf_mots_filtres(self, film, liste_mots):
+        """Comme get_indices_tfidf_mots_filtres, sans garder le résultat.
+
+        :param liste_mots: None pour garder tous les mots.
+        """
+        idf = self.get_tous_idf()
+        mots = self.stockeur_freq.vocabulaire.mots
+        compte = self.stockeur_freq.get_compte_film(film)
+        resultat = {}
+        for ident, indice in zip(compte.ids, self.indices_tf[film]):
+            mot = mots[ident]
+            if liste_mots is None or mot in liste_mots:
+                resultat[mot] = indice * idf[mot]
+        return resultat
+
     def get_indices_tfidf_mots_filtres(self, film, liste_mots):
         """Renvoie le dictionnaire pour les mots donnés et le film donné."""
         if film in self.indices_tf_idf_filtres:
             return self.indices_tf_idf_filtres.get(film)
-        dico = filtrer_dictionnaire_mots(
-            liste_mots, self.get_tf_idf_film(film))
-        """
-        mots_finaux = filter(lambda x: x in liste_mots,
-                             self.get_compte_frequences_film(film).keys())
-        dico = {x: self.get_tf_idf(x, film) for x in mots_finaux}
-        """
+        dico = self.calculer_indices_tfidf_mots_filtres(film, liste_mots)
         self.indices_tf_idf_filtres[film] = dico
         return dico
+
+
+class StockeurTransforme:
+    """Présente des vecteurs transformés avec l'interface du stockeur TF-IDF.
+
+    Les sous-classes définissent `transformer`, appliqué au vecteur de
+    chaque film. Les autres attributs sont ceux du stockeur d'origine.
+    """
+
+    def __init__(self, stockeur_indices):
+        """:param stockeur_indices: stockeur dont les vecteurs sont lus."""
+        self.stockeur_indices = stockeur_indices
+        self.vecteurs = {}
+
+    def __getattr__(self, nom):
+        if nom == "stockeur_indices":
+            # Objet en cours de construction, par exemple par pickle
+            raise AttributeError(nom)
+        return getattr(self.stockeur_indices, nom)
+
+    def transformer(self, dico):
+        """Renvoie le vecteur transformé d'un dictionnaire {mot: indice}."""
+        raise NotImplementedError
+
+    def calculer_indices_tfidf_mots_filtres(self, film, liste_mots):
+        """Comme get_indices_tfidf_mots_filtres, sans garder le résultat."""
+        return self.transformer(
+            self.stockeur_indices.calculer_indices_tfidf_mots_filtres(
+                film, liste_mots))
+
+    def get_indices_tfidf_mots_filtres(self, film, liste_mots):
+        """Renvoie le vecteur transformé des indices des mots donnés.
+
+        Seul le vecteur transformé est gardé en mémoire, pas celui du
+        stockeur d'origine dont il est issu.
+        """
+        if film not in self.vecteurs:
+            self.vecteurs[film] = self.calculer_indices_tfidf_mots_filtres(
+                film, liste_mots)
+        return self.vecteurs[film]
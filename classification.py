@@ -1,6 +1,9 @@
 """Classification non supervisee."""
 
+import contextlib
+import io
 import math
+import multiprocessing
 import random
 
 import distance
@@ -24,7 +27,11 @@ def dictionnaire_moyen(liste_films, mots_pertinents, stockeur_indices):
             id_film, mots_pertinents)
         for mot, indice in dico_filtre.items():
             dico_total[mot] = dico_total.get(mot, 0.0) + indice
-    return {x: y / nb_films for x, y in dico_total.items()}
+    centre = {x: y / nb_films for x, y in dico_total.items()}
+    if hasattr(stockeur_indices, "quantifier"):
+        # Le centre est stocké comme les films
+        return stockeur_indices.quantifier(centre)
+    return centre
 
 
 def generer_centres(num_gps, liste_films, mots_pertinents, stockeur_indices):
@@ -38,6 +45,50 @@ def generer_centres(num_gps, liste_films, mots_pertinents, stockeur_indices):
     return centres
 
 
+def generer_centres_plus_plus(num_gps, liste_films, mots_pertinents,
+                              distance_cosinus, stockeur_indices):
+    """Renvoie des centres tirés selon k-means++.
+
+    Chaque nouveau centre est un film tiré avec une probabilité
+    proportionnelle au carré de sa distance au centre déjà choisi le plus
+    proche: les centres sont bien répartis et le k-means dépend moins du
+    tirage.
+    """
+    if num_gps > len(liste_films):
+        raise ValueError("Impossible de former %d groupes avec %d films." %
+                         (num_gps, len(liste_films)))
+    vecteurs = [stockeur_indices.get_indices_tfidf_mots_filtres(
+        film, mots_pertinents) for film in liste_films]
+    centres = [random.choice(vecteurs)]
+    poids = [math.inf] * len(vecteurs)
+    while len(centres) < num_gps:
+        for index, vecteur in enumerate(vecteurs):
+            poids[index] = min(poids[index], _distance_silhouette(
+                vecteur, centres[-1], distance_cosinus)**2)
+        if sum(poids) > 0:
+            centres.append(random.choices(vecteurs, poids)[0])
+        else:
+            # Tous les films sont confondus avec un centre
+            centres.append(random.choice(vecteurs))
+    return centres
+
+
+def plus_proche_centre(indices, liste_centres, distance_cosinus):
+    """Renvoie le rang du centre le plus proche et la distance à ce centre.
+
+    :param indices: dictionnaire {mot: indice} d'un film ou d'un texte.
+    """
+    mindist = math.inf
+    plus_proche = -1
+    for index, dico_centre in enumerate(liste_centres):
+        dist = distance.distance_dictionnaires(
+            indices, dico_centre, distance_cosinus)
+        if dist <= mindist:
+            mindist = dist
+            plus_proche = index
+    return plus_proche, mindist
+
+
 def classification(films_a_classer, liste_centres, mots_pertinents,
                    distance_cosinus, stockeur_indices):
     """Renvoie une matrice de la composition de chaque groupe et les résidus.
@@ -47,24 +98,60 @@ def classification(films_a_classer, liste_centres, mots_pertinents,
     groupes = [[] for _ in range(len(liste_centres))]
     total_ss = 0
     for film_id in films_a_classer:
-        mindist = math.inf
-        plus_proche = -1
         indices_film = stockeur_indices.get_indices_tfidf_mots_filtres(
             film_id, mots_pertinents)
-        for index, dico_centre in enumerate(liste_centres):
-            dist = distance.distance_dictionnaires(
-                indices_film, dico_centre, distance_cosinus)
-            if dist <= mindist:
-                mindist = dist
-                plus_proche = index
+        plus_proche, mindist = plus_proche_centre(
+            indices_film, liste_centres, distance_cosinus)
         total_ss += mindist**2
         groupes[plus_proche].append(film_id)
     return groupes, total_ss
 
 
+def somme_carres_residus(groupes, mots_pertinents, distance_cosinus,
+                         stockeur_indices):
+    """Renvoie la somme des carrés des distances des films à leur centre.
+
+    Les centres sont recalculés avec le stockeur donné, ce qui permet de
+    mesurer dans l'espace des mots des groupes formés dans un autre espace.
+    Seuls les vecteurs d'un groupe sont en mémoire à la fois, ils ne sont
+    pas gardés par le stockeur.
+    """
+    total_ss = 0
+    for groupe in groupes:
+        vecteurs = [stockeur_indices.calculer_indices_tfidf_mots_filtres(
+            film_id, mots_pertinents) for film_id in groupe]
+        somme = {}
+        for vecteur in vecteurs:
+            for mot, indice in vecteur.items():
+                somme[mot] = somme.get(mot, 0.0) + indice
+        centre = {mot: indice / len(groupe) for mot, indice in somme.items()}
+        for vecteur in vecteurs:
+            total_ss += distance.distance_dictionnaires(
+                vecteur, centre, distance_cosinus)**2
+    return total_ss
+
+
 def kmeans(nb_groupes, liste_films, mots_pertinents,
-           distance_cosinus, stockeur_indices):
-    """Effectue le kmeans."""
+           distance_cosinus, stockeur_indices, centres_initiaux=None,
+           tours_max=None):
+    """Effectue le kmeans.
+
+    :param centres_initiaux: centres d'une classification précédente, pour
+                             l'affiner après une mise à jour du corpus au
+                             lieu de repartir de films tirés au hasard.
+    :param tours_max: nombre maximal de boucles, None pour aller jusqu'à
+                      la convergence.
+    """
+    groupes, centres, _ = kmeans_ssr(
+        nb_groupes, liste_films, mots_pertinents, distance_cosinus,
+        stockeur_indices, centres_initiaux, tours_max)
+    return groupes, centres
+
+
+def kmeans_ssr(nb_groupes, liste_films, mots_pertinents,
+               distance_cosinus, stockeur_indices, centres_initiaux=None,
+               tours_max=None):
+    """Comme `kmeans`, renvoie aussi la SSR de la dernière classification."""
     films_a_classer = filtrer_films_non_vides(
         liste_films, mots_pertinents, stockeur_indices)
     print("""\nTraitement de %d films sur %d au total, soit %.2f%%\
@@ -72,26 +159,186 @@ def kmeans(nb_groupes, liste_films, mots_pertinents,
           % (len(films_a_classer), len(liste_films),
              100 * len(films_a_classer) / len(liste_films)))
 
-    centres = generer_centres(
-        nb_groupes, films_a_classer, mots_pertinents, stockeur_indices)
-    groupes = classification(films_a_classer, centres, mots_pertinents,
-                             distance_cosinus, stockeur_indices)
-    total_ss = -1.0
-    old_total_ss = math.inf
+    if centres_initiaux is None:
+        centres = generer_centres(
+            nb_groupes, films_a_classer, mots_pertinents, stockeur_indices)
+    else:
+        centres = list(centres_initiaux)
+    groupes, total_ss = classification(
+        films_a_classer, centres, mots_pertinents, distance_cosinus,
+        stockeur_indices)
     tours = 0
     change = math.inf
     # On continue tant que la SSR diminue de plus de 0.01% par étape
     changement_min = 0.0001
-    while change > changement_min:
-        if total_ss != -1:
-            old_total_ss = total_ss
-            for index_groupe, liste_films_groupe in enumerate(groupes):
-                centres[index_groupe] = dictionnaire_moyen(
-                    liste_films_groupe, mots_pertinents, stockeur_indices)
+    while change > changement_min and (tours_max is None or
+                                       tours < tours_max):
+        old_total_ss = total_ss
+        for index_groupe, liste_films_groupe in enumerate(groupes):
+            centres[index_groupe] = dictionnaire_moyen(
+                liste_films_groupe, mots_pertinents, stockeur_indices)
         groupes, total_ss = classification(
             films_a_classer, centres, mots_pertinents,
             distance_cosinus, stockeur_indices)
         tours += 1
-        change = 1 - total_ss / old_total_ss
+        change = 1 - total_ss / old_total_ss if old_total_ss > 0 else 0.0
         print("Boucle %d:\tSSR=%.2f\t%.2f%%" % (tours, total_ss, 100 * change))
-    return groupes, centres
+    return groupes, centres, total_ss
+
+
+class VecteursFiges:
+    """Stockeur minimal qui sert des vecteurs déjà calculés.
+
+    Permet de calculer une seule fois les vecteurs des films et de les
+    partager entre plusieurs k-means, y compris dans d'autres processus.
+    """
+
+    def __init__(self, films, mots_pertinents, stockeur_indices):
+        """Lit le vecteur de chaque film dans le stockeur donné."""
+        self.vecteurs = {film: stockeur_indices.get_indices_tfidf_mots_filtres(
+            film, mots_pertinents) for film in films}
+        if hasattr(stockeur_indices, "quantificateur"):
+            # Les centres sont alors stockés comme les films
+            self.quantifier = stockeur_indices.quantificateur()
+
+    def get_indices_tfidf_mots_filtres(self, film, liste_mots):
+        """Renvoie le vecteur du film, les mots sont déjà filtrés."""
+        return self.vecteurs[film]
+
+
+def _distance_silhouette(prm, sec, distance_cosinus):
+    dist = distance.distance_dictionnaires(prm, sec, distance_cosinus)
+    # La distance euclidienne est renvoyée au carré
+    return dist if distance_cosinus else math.sqrt(dist)
+
+
+def matrice_distances(echantillon, vecteurs, distance_cosinus):
+    """Distances deux à deux entre les films d'un échantillon."""
+    matrice = [[0.0] * len(echantillon) for _ in echantillon]
+    for i, film_i in enumerate(echantillon):
+        for j in range(i + 1, len(echantillon)):
+            dist = _distance_silhouette(
+                vecteurs.get_indices_tfidf_mots_filtres(film_i, None),
+                vecteurs.get_indices_tfidf_mots_filtres(echantillon[j], None),
+                distance_cosinus)
+            matrice[i][j] = matrice[j][i] = dist
+    return matrice
+
+
+def silhouette_echantillon(groupes, echantillon, matrice):
+    """Estime le coefficient de silhouette moyen sur un échantillon.
+
+    Seules les distances entre films de l'échantillon sont utilisées: le
+    coût ne dépend pas du nombre total de films.
+
+    :param echantillon: liste des films tirés au hasard.
+    :param matrice: distances entre ces films, voir `matrice_distances`.
+    """
+    etiquettes = {}
+    for index_groupe, groupe in enumerate(groupes):
+        for film in groupe:
+            etiquettes[film] = index_groupe
+    groupes_echantillon = [etiquettes[film] for film in echantillon]
+    total = 0.0
+    for i, groupe_i in enumerate(groupes_echantillon):
+        sommes = {}
+        nombres = {}
+        for j, groupe_j in enumerate(groupes_echantillon):
+            if i != j:
+                sommes[groupe_j] = sommes.get(groupe_j, 0.0) + matrice[i][j]
+                nombres[groupe_j] = nombres.get(groupe_j, 0) + 1
+        if groupe_i not in nombres or len(nombres) < 2:
+            # Seul de son groupe dans l'échantillon: silhouette nulle
+            continue
+        interne = sommes[groupe_i] / nombres[groupe_i]
+        externe = min(sommes[groupe] / nombres[groupe]
+                      for groupe in nombres if groupe != groupe_i)
+        if max(interne, externe) > 0:
+            total += (externe - interne) / max(interne, externe)
+    return total / len(echantillon)
+
+
+# Données partagées par les processus de `choisir_nb_groupes`
+_SELECTION = {}
+
+
+def _initialiser_selection(donnees):
+    _SELECTION.update(donnees)
+
+
+def _evaluer_nb_groupes(nb_groupes):
+    """Lance les k-means d'un k et renvoie (k, SSR, silhouette estimée).
+
+    Chaque essai part de centres tirés selon k-means++; le k-means de plus
+    faible SSR est gardé.
+    """
+    donnees = _SELECTION
+    if donnees["graine"] is not None:
+        random.seed(donnees["graine"] + nb_groupes)
+    meilleur = None
+    # Les messages de chaque k-means se mélangeraient entre processus
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(donnees["nb_essais"]):
+            centres = generer_centres_plus_plus(
+                nb_groupes, donnees["films"], donnees["mots"],
+                donnees["cosinus"], donnees["vecteurs"])
+            groupes, _, total_ss = kmeans_ssr(
+                nb_groupes, donnees["films"], donnees["mots"],
+                donnees["cosinus"], donnees["vecteurs"], centres)
+            if meilleur is None or total_ss < meilleur[1]:
+                meilleur = groupes, total_ss
+    groupes, total_ss = meilleur
+    return (nb_groupes, total_ss, silhouette_echantillon(
+        groupes, donnees["echantillon"], donnees["matrice"]))
+
+
+def choisir_nb_groupes(k_min, k_max, liste_films, mots_pertinents,
+                       distance_cosinus, stockeur_indices,
+                       taille_echantillon=500, nb_processus=None,
+                       graine=None, nb_essais=3):
+    """Cherche le nombre de groupes qui maximise la silhouette.
+
+    Les vecteurs des films et les distances entre films de l'échantillon
+    sont calculés une seule fois, puis des k-means sont lancés pour chaque
+    k entre k_min et k_max inclus, en parallèle.
+
+    :param taille_echantillon: nombre de films tirés pour estimer la
+                               silhouette.
+    :param nb_processus: nombre de processus, None pour un par processeur.
+    :param nb_essais: nombre de k-means lancés pour chaque k, le meilleur
+                      étant gardé.
+    Renvoie (meilleur k, dictionnaire k -> SSR, dictionnaire k ->
+    silhouette).
+    """
+    if not 2 <= k_min <= k_max:
+        # La silhouette n'est pas définie pour un seul groupe
+        raise ValueError("Nombres de groupes invalides: il faut "
+                         "2 <= k_min <= k_max (k_min=%d, k_max=%d)." %
+                         (k_min, k_max))
+    films = filtrer_films_non_vides(liste_films, mots_pertinents,
+                                    stockeur_indices)
+    if k_max > len(films):
+        raise ValueError("Impossible de former %d groupes avec %d films." %
+                         (k_max, len(films)))
+    vecteurs = VecteursFiges(films, mots_pertinents, stockeur_indices)
+    tirage = random.Random(graine)
+    echantillon = tirage.sample(films, min(taille_echantillon, len(films)))
+    donnees = {
+        "films": films, "mots": mots_pertinents, "cosinus": distance_cosinus,
+        "vecteurs": vecteurs, "echantillon": echantillon,
+        "matrice": matrice_distances(echantillon, vecteurs, distance_cosinus),
+        "graine": graine, "nb_essais": nb_essais}
+    valeurs_k = list(range(k_min, k_max + 1))
+    if nb_processus == 1:
+        _initialiser_selection(donnees)
+        resultats = [_evaluer_nb_groupes(k) for k in valeurs_k]
+    else:
+        with multiprocessing.Pool(nb_processus, _initialiser_selection,
+                                  (donnees,)) as pool:
+            # Les grands k d'abord: ce sont les plus longs
+            resultats = pool.map(_evaluer_nb_groupes, valeurs_k[::-1],
+                                 chunksize=1)
+    ssr = {k: total_ss for k, total_ss, _ in sorted(resultats)}
+    silhouettes = {k: silhouette for k, _, silhouette in sorted(resultats)}
+    meilleur = max(silhouettes, key=silhouettes.get)
+    return meilleur, ssr, silhouettes
@@ -47,7 +47,10 @@ def distance_dictionnaires(prm, sec, cosinus=True,
     if (prm_idx, sec_idx) in StockeurDistances.distances.keys():
         return StockeurDistances.distances[(prm_idx, sec_idx)]
 
-    if cosinus:
+    if hasattr(prm, "distance") and hasattr(sec, "distance"):
+        # Vecteurs quantifiés: calcul direct sur leurs tableaux
+        dist = prm.distance(sec, cosinus)
+    elif cosinus:
         num = sum([prm[i] * sec[i] for i in set(prm).intersection(set(sec))])
         norme_prm = sum((x * x for x in prm.values()))
         norme_sec = sum((x * x for x in sec.values()))
@@ -0,0 +1,51 @@
+"""Lecture anticipée des fichiers d'un dossier.
+
+Les fichiers sont lus par plusieurs fils pendant que le programme traite les
+précédents, ce qui masque l'attente du disque (disque réseau, cache froid).
+"""
+
+import collections
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# Nombre de fils qui lisent les fichiers en parallèle
+NB_FILS = 8
+
+# Nombre maximal de fichiers lus à l'avance et pas encore traités
+TAILLE_FILE = 64
+
+
+def _lire(chemin):
+    with open(chemin, encoding='utf8') as fichier:
+        return fichier.read()
+
+
+def lire_fichiers(dossier, noms, nb_fils=NB_FILS, taille_file=TAILLE_FILE):
+    """Renvoie un générateur de (nom, contenu) dans l'ordre des noms.
+
+    Au plus `taille_file` lectures sont en cours ou en attente d'être
+    consommées: une nouvelle lecture n'est lancée que quand le programme
+    prend un fichier, la mémoire utilisée reste donc bornée.
+
+    :param dossier: dossier contenant les fichiers.
+    :param noms: liste des noms de fichiers à lire.
+    """
+    noms = iter(noms)
+    en_cours = collections.deque()
+    lecteurs = ThreadPoolExecutor(max_workers=nb_fils)
+    try:
+        for nom in noms:
+            en_cours.append((nom, lecteurs.submit(
+                _lire, os.path.join(dossier, nom))))
+            if len(en_cours) >= taille_file:
+                break
+        while en_cours:
+            nom, futur = en_cours.popleft()
+            suivant = next(noms, None)
+            if suivant is not None:
+                en_cours.append((suivant, lecteurs.submit(
+                    _lire, os.path.join(dossier, suivant))))
+            yield nom, futur.result()
+    finally:
+        # Si le programme s'arrête avant la fin, on abandonne les lectures
+        lecteurs.shutdown(wait=False, cancel_futures=True)
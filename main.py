@@ -1,13 +1,31 @@
-"""Module principal pour appeler chaque partie du programme."""
+"""Module principal pour appeler chaque partie du programme.
 
+Utilisation en ligne de commande, par exemple:
+
+    python main.py cluster --nb-groupes 10
+    python main.py update
+    python main.py predict --nb-voisins 3 --imdb /chemin/vers/imdb
+    python main.py serve --http 8000
+
+Sans sous-commande, toutes les étapes sont exécutées. Les constantes
+ci-dessous sont les valeurs par défaut des options.
+"""
+
+import argparse
+import contextlib
+import functools
+import hashlib
 import os
+import random
+import sys
 import time
-from tkinter.filedialog import askdirectory
 
 import analyse
 import classification
 import distance
-import traitement
+import pipeline
+import quantification
+import reduction
 import voisins
 
 
@@ -15,10 +33,10 @@ import voisins
 PARAMETRES
 """
 
-# Si vrai, supprimer et réécrire le dossier de films. Sinon, sauter la partie 1
-# Nécessaire la première fois que le programme tourne et à chaque fois
-# qu'on change le nombre de commentaires.
-OVERWRITE = True
+# Si vrai, ignorer les résultats en cache et recalculer toutes les étapes.
+# Sinon, seules les étapes dont les entrées ou les paramètres ont changé sont
+# recalculées.
+OVERWRITE = False
 
 # Nombre de commentaires à traiter (25000 pour tous)
 NOMBRE_COMMENTAIRES = 25000
@@ -26,6 +44,20 @@ NOMBRE_COMMENTAIRES = 25000
 # Nombre de groupes pour le k-means
 NB_GROUPES = 7
 
+# Nombre maximal de boucles du k-means pour affiner les groupes existants
+# lors d'une mise à jour
+TOURS_MISE_A_JOUR = 5
+
+# Intervalle des nombres de groupes essayés par la commande select-k, et
+# nombre de films tirés pour estimer la silhouette de chaque classification
+NB_GROUPES_MIN = 2
+NB_GROUPES_MAX = 15
+TAILLE_ECHANTILLON = 500
+
+# Nombre de k-means lancés pour chaque nombre de groupes essayé, le meilleur
+# étant gardé
+NB_ESSAIS = 3
+
 # Nombre de mots pertinents à utiliser pour la classification
 NB_MOTS = 1000
 
@@ -38,6 +70,16 @@ PROPORTION_MAXIMUM = 0.5
 # (max pour l'ensemble des textes). Sinon, utiliser l'indice IDF.
 TFIDF = True
 
+# Nombre de dimensions sur lesquelles projeter les vecteurs des films avant
+# la classification et la recherche des voisins. 0 pour ne pas réduire.
+DIMENSIONS = 0
+
+# Précision des vecteurs des films et des centres: "float64" (pleine
+# précision), "float32" ou "int8" (entiers 8 bits avec une échelle par
+# vecteur). En dessous de float64, l'écart avec la pleine précision est
+# affiché.
+PRECISION = "float64"
+
 # Si vrai, utiliser la distance cosinus. Sinon, utiliser la distance
 # euclidienne.
 COSINUS = True
@@ -45,6 +87,14 @@ COSINUS = True
 # Active l'indicateur de progression, marche mal sous Windows
 PROGRESS = True
 
+# Si vrai, compiler l'index des titres en un index binaire projeté en mémoire
+# au lieu de lire tout le fichier texte à chaque lancement.
+INDEX_BINAIRE = False
+
+# Graine du générateur aléatoire pour le k-means et le choix des référents.
+# None pour un tirage différent à chaque calcul.
+GRAINE = None
+
 """BONUS"""
 
 # Nombre de voisins les plus proches à prendre en compte.
@@ -63,19 +113,42 @@ TOLERENCE = 1.5
 REGLAGES
 """
 
-if os.path.exists(os.path.join("..", "imdb")):  # dossier parent du fichier
-    PATH_TO_RESOURCES = os.path.join("..", "imdb")
-elif os.path.exists("imdb"):  # meme dossier que le fichier
-    PATH_TO_RESOURCES = "imdb"
-else:  # autre part
-    PATH_TO_RESOURCES = askdirectory(
-        mustexist=True,
-        title="Veuillez sélectionner votre dossier 'imdb'.")
 
-PATH_TO_INDEX = os.path.abspath(os.path.join(PATH_TO_RESOURCES, "title_index"))
-PATH_TO_COMMENTS = os.path.abspath(os.path.join(PATH_TO_RESOURCES, "comments"))
-PATH_TO_FILMS = os.path.abspath(os.path.join(PATH_TO_RESOURCES, "films"))
-PATH_TO_MOYENNES = os.path.abspath(os.path.join(PATH_TO_RESOURCES, "moyennes"))
+def trouver_dossier_imdb(dossier=None):
+    """Renvoie le chemin du dossier 'imdb'.
+
+    Cherche dans le dossier parent puis le dossier courant. La boîte de
+    dialogue n'est proposée qu'en dernier recours et si un affichage est
+    disponible, pour que le programme tourne sur un serveur.
+    """
+    if dossier is not None:
+        if not os.path.isdir(dossier):
+            raise IOError("Pas de dossier 'imdb' au chemin: %s" % dossier)
+        return dossier
+    if os.path.exists(os.path.join("..", "imdb")):  # dossier parent
+        return os.path.join("..", "imdb")
+    if os.path.exists("imdb"):  # meme dossier que le fichier
+        return "imdb"
+    if os.name != "nt" and not os.environ.get("DISPLAY"):
+        raise IOError("Dossier 'imdb' introuvable, utiliser l'option --imdb.")
+    # Import tardif: tkinter est lent à charger et inutile sans affichage
+    from tkinter.filedialog import askdirectory
+    return askdirectory(mustexist=True,
+                        title="Veuillez sélectionner votre dossier 'imdb'.")
+
+
+def ajouter_chemins(args):
+    """Complète les arguments avec les chemins vers les ressources."""
+    ressources = trouver_dossier_imdb(args.imdb)
+    args.index = os.path.abspath(os.path.join(ressources, "title_index"))
+    args.commentaires = os.path.abspath(os.path.join(ressources, "comments"))
+    args.films = os.path.abspath(os.path.join(ressources, "films"))
+    args.moyennes = os.path.abspath(os.path.join(ressources, "moyennes"))
+    args.cache = os.path.abspath(
+        args.cache or os.path.join(ressources, "cache"))
+    # Clé de l'étape de nettoyage qui a produit le dossier des films
+    args.cle_films = args.films + ".cle"
+    return args
 
 
 """
@@ -93,71 +166,532 @@ def _afficher_groupes(groupes, centres):
         print("=" * 50)
 
 
-def partie1():
+def _empreinte_corpus(args):
+    """Renvoie une empreinte des fichiers de commentaires et de l'index.
+
+    Seuls les noms, tailles et dates de modification sont lus, ce qui évite
+    de relire tout le corpus pour savoir s'il a changé.
+    """
+    empreinte = hashlib.sha256()
+    for chemin in (args.index, args.commentaires):
+        infos = os.stat(chemin)
+        empreinte.update(("%s:%d:%d\n" % (chemin, infos.st_size,
+                                          infos.st_mtime_ns)).encode('utf8'))
+    with os.scandir(args.commentaires) as entrees:
+        for entree in sorted(entrees, key=lambda x: x.name):
+            infos = entree.stat()
+            empreinte.update(("%s:%d:%d\n" % (entree.name, infos.st_size,
+                                              infos.st_mtime_ns))
+                             .encode('utf8'))
+    return empreinte.hexdigest()
+
+
+def _signature_corpus(args):
+    """Vérification rapide du corpus, lue à chaque exécution.
+
+    La date de modification du dossier des commentaires change quand un
+    fichier est ajouté ou retiré; celles des fichiers ne sont lues que par
+    `_empreinte_corpus`. Renvoie None si le corpus est absent: les
+    résultats en cache restent alors utilisables.
+    """
+    try:
+        index = os.stat(args.index)
+        commentaires = os.stat(args.commentaires)
+    except OSError:
+        return None
+    return [index.st_size, index.st_mtime_ns, commentaires.st_mtime_ns]
+
+
+def _films_a_jour(args, cle):
+    """Vérifie que le dossier des films a été écrit par l'étape donnée."""
+    if not (os.path.exists(args.films) and
+            os.path.exists(args.moyennes) and
+            os.path.exists(args.cle_films)):
+        return False
+    with open(args.cle_films, encoding='utf8') as fichier:
+        return fichier.read().strip() == cle
+
+
+def _associateur(args):
+    # Import tardif: seules les étapes qui lisent l'index en ont besoin
+    import traitement
+    return traitement.ouvrir_associateur(args.index, args.index_binaire)
+
+
+def etape_corpus(args):
+    """Renvoie l'empreinte du corpus, qui sert de clé à l'étape.
+
+    Elle est recalculée quand `_signature_corpus` a changé, quand le
+    nettoyage doit être refait, ou par la commande preprocess qui voit
+    aussi les fichiers modifiés sans changer le dossier.
+    """
+    return _empreinte_corpus(args)
+
+
+def partie1(args, corpus, cle):
     """Appelle la partie 1, traitement."""
-    associateur = traitement.AssociateurCommentairesFilms(PATH_TO_INDEX)
-    traiteur = traitement.Traitement(PATH_TO_COMMENTS,
-                                     PATH_TO_FILMS,
-                                     PATH_TO_MOYENNES)
-    if OVERWRITE:
-        traiteur.traiter(nb_com=NOMBRE_COMMENTAIRES,
-                         progress=PROGRESS,
-                         associateur=associateur)
-    else:
-        print("Traitement sauté.")
-    return associateur
-
-
-def partie2():
+    import traitement
+    traiteur = traitement.Traitement(args.commentaires,
+                                     args.films,
+                                     args.moyennes)
+    moyennes = traiteur.traiter(nb_com=args.nb_commentaires,
+                                progress=args.progression,
+                                associateur=_associateur(args))
+    with open(args.cle_films, 'w', encoding='utf8') as fichier:
+        fichier.write(cle)
+    return moyennes
+
+
+def etape_comptage(args, moyennes, cle):
+    """Compte les occurences des mots de chaque film."""
+    stockeur_freq = analyse.StockeurFrequences()
+    stockeur_freq.compter_tous_films(args.films)
+    return stockeur_freq
+
+
+def partie2(args, stockeur_freq, cle):
     """Appelle la parie 2, analyse."""
-    stock_indices = analyse.StockeurIndicesTfIdf(dossier=PATH_TO_FILMS,
-                                                 prop_min=PROPORTION_MINIMUM,
-                                                 prop_max=PROPORTION_MAXIMUM)
+    stock_indices = analyse.StockeurIndicesTfIdf(dossier=args.films,
+                                                 prop_min=args.prop_min,
+                                                 prop_max=args.prop_max,
+                                                 stockeur_freq=stockeur_freq)
     return stock_indices
 
 
-def partie3(stockeur):
+def partie3(args, stockeur, cle):
     """Appelle la partie 3, distance."""
-    mots_perti = distance.plus_pertinents(num_mots=NB_MOTS,
+    mots_perti = distance.plus_pertinents(num_mots=args.nb_mots,
                                           mots=stockeur.get_tous_idf().keys(),
                                           stockeur_indices=stockeur,
-                                          utiliser_tfidf=TFIDF)
+                                          utiliser_tfidf=args.tfidf)
     return mots_perti
 
 
-def partie4(mots_perti, stockeur):
-    """Appelle la partie 4, classification."""
-    return classification.kmeans(nb_groupes=NB_GROUPES,
-                                 liste_films=stockeur.indices_tf_idf.keys(),
-                                 mots_pertinents=mots_perti,
-                                 distance_cosinus=COSINUS,
-                                 stockeur_indices=stockeur)
+def etape_projection(args, mots_perti, cle):
+    """Tire la projection des vecteurs, None si on ne réduit pas."""
+    if args.dimensions <= 0:
+        return None
+    return reduction.Projection(mots_perti, args.dimensions,
+                                args.graine or 0)
+
+
+def _stockeurs(args, stockeur, projection):
+    """Renvoie (stockeur en pleine précision, stockeur des vecteurs comparés
+    par le k-means et les kNN).
+
+    Le premier est réduit si une projection est donnée, le second est en
+    plus quantifié selon la précision demandée. Ils sont créés une seule
+    fois par étape pour que chaque film ne soit projeté et quantifié qu'une
+    fois.
+    """
+    stockeur_reduit = reduction.reduire(stockeur, projection)
+    return stockeur_reduit, quantification.quantifier_stockeur(
+        stockeur_reduit, args.precision)
+
 
+def _stockeur_vecteurs(args, stockeur, projection):
+    """Renvoie le stockeur des vecteurs comparés par le k-means et les kNN."""
+    return _stockeurs(args, stockeur, projection)[1]
 
-def bonus(stockeur_indices, mots_perti, asso):
+
+def partie4(args, stockeur, mots_perti, projection, cle):
+    """Appelle la partie 4, classification."""
+    if args.graine is not None:
+        random.seed(args.graine)
+    stockeur_reduit, stockeur_vecteurs = _stockeurs(args, stockeur,
+                                                    projection)
+    # Les vecteurs calculés pour la mesure restent en cache pour le k-means
+    memoire = quantification.memoire_vecteurs(
+        stockeur_vecteurs, stockeur.get_films(), mots_perti)
+    groupes, centres = classification.kmeans(
+        nb_groupes=args.nb_groupes,
+        liste_films=stockeur.get_films(),
+        mots_pertinents=mots_perti,
+        distance_cosinus=args.cosinus,
+        stockeur_indices=stockeur_vecteurs)
+    print("Mémoire des vecteurs des films en %s: %d Ko." %
+          (args.precision, memoire // 1024))
+    pic = quantification.pic_memoire_processus()
+    if pic is not None:
+        print("Pic de mémoire du processus: %d Ko." % pic)
+    if args.precision != "float64":
+        identiques = quantification.rapport_classification(
+            [film for groupe in groupes for film in groupe], centres,
+            mots_perti, args.cosinus, stockeur_reduit, stockeur_vecteurs)
+        print("Précision %s: %.2f%% des films dans le même groupe qu'en "
+              "float64." % (args.precision, 100 * identiques))
+    # Mesurée sur les vecteurs complets pour comparer avec et sans réduction
+    print("SSR dans l'espace des mots: %.2f" %
+          classification.somme_carres_residus(
+              groupes, mots_perti, args.cosinus, stockeur))
+    return groupes, centres
+
+
+def etape_selection(args, stockeur, mots_perti, projection, cle):
+    """Lance le k-means pour chaque nombre de groupes et les compare."""
+    return classification.choisir_nb_groupes(
+        args.nb_groupes_min, args.nb_groupes_max,
+        liste_films=stockeur.get_films(),
+        mots_pertinents=mots_perti,
+        distance_cosinus=args.cosinus,
+        stockeur_indices=_stockeur_vecteurs(args, stockeur, projection),
+        taille_echantillon=args.taille_echantillon,
+        nb_processus=args.nb_processus,
+        graine=args.graine,
+        nb_essais=args.nb_essais)
+
+
+def bonus(args, moyennes, stockeur_indices, mots_perti, projection, cle):
+    """Prédit la note des films à partir de leurs plus proches voisins."""
     print("BONUS")
+    if args.graine is not None:
+        random.seed(args.graine)
+    liste_films = list(
+        stockeur_indices.get_stockeur_frequences().occurences.keys())
+    stockeur_reduit, stockeur_vecteurs = _stockeurs(args, stockeur_indices,
+                                                    projection)
+    resultats = voisins.devine_toutes_notes(
+        args.moyennes, args.nb_voisins, args.nb_referents, args.tolerence,
+        liste_films, mots_perti, stockeur_vecteurs, _associateur(args))
+    if args.precision != "float64":
+        ecart, memes_voisins = quantification.rapport_notes(
+            liste_films, args.nb_voisins, args.nb_referents, mots_perti,
+            moyennes, stockeur_reduit, stockeur_vecteurs)
+        print("Précision %s: écart moyen de %.3f avec les notes prédites en "
+              "float64, voisins identiques pour %.2f%% des films." %
+              (args.precision, ecart, 100 * memes_voisins))
+    return resultats
+
+
+def etape_modele(args, moyennes, stockeur_indices, mots_perti, projection,
+                 groupes_centres, cle):
+    """Extrait le modèle utilisé par le service de prédiction."""
+    import service
+    if args.graine is not None:
+        random.seed(args.graine)
+    return service.construire_modele(
+        _stockeur_vecteurs(args, stockeur_indices, projection), mots_perti,
+        groupes_centres[1], moyennes, args.nb_referents, args.nb_voisins,
+        args.cosinus, projection)
+
+
+def construire_pipeline(args):
+    """Déclare les étapes du programme et leurs paramètres."""
+    pipe = pipeline.Pipeline(args.cache, forcer=args.forcer)
+
+    def etape(nom, fonction, dependances=(), parametres=None, valide=None,
+              empreinte=False, signature=None):
+        # Chaque fonction d'étape reçoit les arguments en premier
+        if valide is not None:
+            valide = functools.partial(valide, args)
+        if signature is not None:
+            signature = functools.partial(signature, args)
+        pipe.ajouter(pipeline.Etape(nom, functools.partial(fonction, args),
+                                    dependances, parametres, valide,
+                                    empreinte, signature))
+
+    etape("corpus", etape_corpus,
+          parametres={"commentaires": args.commentaires, "index": args.index},
+          empreinte=True, signature=_signature_corpus)
+    etape("nettoyage", partie1, ["corpus"],
+          {"nb_commentaires": args.nb_commentaires,
+           "films": args.films, "moyennes": args.moyennes},
+          valide=_films_a_jour)
+    etape("comptage", etape_comptage, ["nettoyage"])
+    etape("tfidf", partie2, ["comptage"],
+          {"prop_min": args.prop_min, "prop_max": args.prop_max})
+    etape("mots", partie3, ["tfidf"],
+          {"nb_mots": args.nb_mots, "tfidf": args.tfidf})
+    etape("projection", etape_projection, ["mots"],
+          {"dimensions": args.dimensions, "graine": args.graine})
+    etape("groupes", partie4, ["tfidf", "mots", "projection"],
+          {"nb_groupes": args.nb_groupes, "cosinus": args.cosinus,
+           "graine": args.graine, "precision": args.precision})
+    etape("selection", etape_selection, ["tfidf", "mots", "projection"],
+          {"nb_groupes_min": args.nb_groupes_min,
+           "nb_groupes_max": args.nb_groupes_max,
+           "taille_echantillon": args.taille_echantillon,
+           "nb_essais": args.nb_essais,
+           "cosinus": args.cosinus, "graine": args.graine,
+           "precision": args.precision})
+    etape("predictions", bonus,
+          ["nettoyage", "tfidf", "mots", "projection"],
+          {"nb_voisins": args.nb_voisins, "nb_referents": args.nb_referents,
+           "tolerence": args.tolerence, "graine": args.graine,
+           "precision": args.precision})
+    etape("modele", etape_modele,
+          ["nettoyage", "tfidf", "mots", "projection", "groupes"],
+          {"nb_voisins": args.nb_voisins, "nb_referents": args.nb_referents,
+           "graine": args.graine, "precision": args.precision})
+    return pipe
+
+
+def commande_preprocess(pipe, args):
+    """Nettoie les commentaires et écrit les fichiers des films.
+
+    L'empreinte du corpus est recalculée pour prendre en compte les
+    commentaires ajoutés ou modifiés depuis le dernier nettoyage.
+    """
+    pipe.executer("corpus")
+    pipe.executer("nettoyage")
+
+
+def commande_index(pipe, args):
+    """Compte les mots et calcule les indices TF-IDF."""
+    stockeur = pipe.executer("tfidf")
+    print("%d films indexés." %
+          stockeur.get_stockeur_frequences().get_nb_films_total())
+
+
+def commande_cluster(pipe, args):
+    """Classe les films en groupes."""
+    deb = time.time()
+    groupes, centres = pipe.executer("groupes")
+    _afficher_classification(pipe, args, groupes, centres)
+    print("Classification terminée en %.3fs." % (time.time() - deb))
+
+
+def _afficher_classification(pipe, args, groupes, centres):
+    if args.dimensions > 0:
+        # Les centres projetés n'ont plus de mots: on les recalcule
+        stockeur, mots_perti = pipe.executer("tfidf"), pipe.executer("mots")
+        centres = [classification.dictionnaire_moyen(
+            groupe, mots_perti, stockeur) for groupe in groupes]
+    _afficher_groupes(groupes, centres)
+
+
+def commande_update(pipe, args):
+    """Met à jour les indices et les groupes avec les films modifiés.
+
+    Part des derniers indices et groupes calculés avec les mêmes options:
+    seuls les films ajoutés, modifiés ou retirés sont recomptés, et les
+    centres existants sont affinés par quelques boucles du k-means.
+    """
+    deb = time.time()
+    stockeur = pipe.resultat_precedent("tfidf")
+    groupes_centres = pipe.resultat_precedent("groupes")
+    if stockeur is None or groupes_centres is None:
+        print("Aucune classification précédente: calcul complet.")
+        commande_cluster(pipe, args)
+        return
+    pipe.executer("nettoyage")
+    modifies, retires = stockeur.films_modifies(args.films)
+    for film in retires:
+        stockeur.retirer_film(film)
+    for film in modifies:
+        stockeur.ajouter_film_fichier(film, args.films)
+    print("%d films ajoutés ou modifiés, %d retirés." %
+          (len(modifies), len(retires)))
+    pipe.enregistrer("comptage", stockeur.get_stockeur_frequences())
+    pipe.enregistrer("tfidf", stockeur)
+    mots_perti = pipe.executer("mots")
+    stockeur_vecteurs = _stockeur_vecteurs(
+        args, stockeur, pipe.executer("projection"))
+    # Les centres quantifiés dépendent du vocabulaire de l'ancien stockeur
+    centres = [dict(centre.items()) for centre in groupes_centres[1]]
+    if hasattr(stockeur_vecteurs, "quantifier"):
+        centres = [stockeur_vecteurs.quantifier(centre)
+                   for centre in centres]
+    groupes, centres = classification.kmeans(
+        nb_groupes=args.nb_groupes,
+        liste_films=stockeur.get_films(),
+        mots_pertinents=mots_perti,
+        distance_cosinus=args.cosinus,
+        stockeur_indices=stockeur_vecteurs,
+        centres_initiaux=centres,
+        tours_max=args.tours)
+    pipe.enregistrer("groupes", (groupes, centres))
+    _afficher_classification(pipe, args, groupes, centres)
+    print("Mise à jour terminée en %.3fs." % (time.time() - deb))
+
+
+def commande_select_k(pipe, args):
+    """Choisit le nombre de groupes avec la silhouette."""
+    deb = time.time()
+    meilleur, ssr, silhouettes = pipe.executer("selection")
+    print("k\tSSR\tSilhouette")
+    for nb_groupes in sorted(ssr):
+        print("%d\t%.2f\t%.4f" % (nb_groupes, ssr[nb_groupes],
+                                   silhouettes[nb_groupes]))
+    print("Meilleur nombre de groupes: %d (silhouette %.4f)" %
+          (meilleur, silhouettes[meilleur]))
+    print("Sélection terminée en %.3fs." % (time.time() - deb))
+
+
+def commande_predict(pipe, args):
+    """Prédit la note des films à partir de leurs voisins."""
     deb = time.time()
-    liste_films = stockeur_indices.get_stockeur_frequences().occurences.keys()
-    vrai, corr = voisins.devine_toutes_notes(
-        PATH_TO_MOYENNES, NB_VOISINS, NB_REFERENTS, TOLERENCE,
-        liste_films, mots_perti, stockeur_indices, asso)
+    vrai, corr, diff = pipe.executer("predictions")
     print("Bonus effectué en %.3fs" % (time.time() - deb))
     print("Correct (total): %.2f%%" % (100 * vrai))
     print("Correct (corrigé): %.2f%%" % (100 * corr))
+    print("Ecart quadratique moyen: %.2f" % diff)
+
+
+def commande_all(pipe, args):
+    """Enchaîne la classification et la prédiction des notes."""
+    commande_cluster(pipe, args)
+    commande_predict(pipe, args)
 
 
-def main():
+def commande_serve(pipe, args):
+    """Classe et note de nouveaux commentaires au fil de l'eau."""
+    import service
+    modele = pipe.executer("modele")
+    regroupeur = service.Regroupeur(modele, args.taille_lot,
+                                    args.delai_lot / 1000)
+    if args.http is None:
+        service.servir_flux(regroupeur, sys.stdin, args.sortie)
+    else:
+        service.servir_http(regroupeur, args.hote, args.http)
+
+
+def creer_parser():
+    """Renvoie l'analyseur des arguments de la ligne de commande.
+
+    Chaque sous-commande accepte les options de toutes les étapes dont elle
+    dépend.
+    """
+    commun = argparse.ArgumentParser(add_help=False)
+    commun.add_argument("--imdb", default=None,
+                        help="dossier 'imdb' contenant les commentaires")
+    commun.add_argument("--cache", default=None,
+                        help="dossier du cache (défaut: imdb/cache)")
+    commun.add_argument("--forcer", action="store_true", default=OVERWRITE,
+                        help="ignorer le cache et tout recalculer")
+    commun.add_argument("--graine", type=int, default=GRAINE,
+                        help="graine du générateur aléatoire")
+    commun.add_argument("--index-binaire", action="store_true",
+                        default=INDEX_BINAIRE,
+                        help="utiliser l'index des titres compilé en binaire")
+    commun.add_argument("--sans-progression", dest="progression",
+                        action="store_false", default=PROGRESS,
+                        help="désactiver l'indicateur de progression")
+    commun.add_argument("--nb-commentaires", type=int,
+                        default=NOMBRE_COMMENTAIRES,
+                        help="nombre de commentaires à traiter")
+
+    index = argparse.ArgumentParser(add_help=False, parents=[commun])
+    index.add_argument("--prop-min", type=float, default=PROPORTION_MINIMUM,
+                       help="proportion minimale de films contenant un mot")
+    index.add_argument("--prop-max", type=float, default=PROPORTION_MAXIMUM,
+                       help="proportion maximale de films contenant un mot")
+
+    mots = argparse.ArgumentParser(add_help=False, parents=[index])
+    mots.add_argument("--nb-mots", type=int, default=NB_MOTS,
+                      help="nombre de mots pertinents")
+    mots.add_argument("--idf", dest="tfidf", action="store_false",
+                      default=TFIDF,
+                      help="choisir les mots selon l'IDF et non le TF-IDF")
+    mots.add_argument("--euclidienne", dest="cosinus", action="store_false",
+                      default=COSINUS,
+                      help="utiliser la distance euclidienne")
+    mots.add_argument("--dimensions", type=int, default=DIMENSIONS,
+                      help="projeter les vecteurs sur ce nombre de "
+                           "dimensions (0 pour ne pas réduire)")
+    mots.add_argument("--precision", choices=quantification.PRECISIONS,
+                      default=PRECISION,
+                      help="précision des vecteurs des films et des centres")
+
+    cluster = argparse.ArgumentParser(add_help=False)
+    cluster.add_argument("--nb-groupes", type=int, default=NB_GROUPES,
+                         help="nombre de groupes du k-means")
+
+    update = argparse.ArgumentParser(add_help=False)
+    update.add_argument("--tours", type=int, default=TOURS_MISE_A_JOUR,
+                        help="nombre maximal de boucles du k-means pour "
+                             "affiner les groupes")
+
+    selection = argparse.ArgumentParser(add_help=False)
+    selection.add_argument("--nb-groupes-min", type=int,
+                           default=NB_GROUPES_MIN,
+                           help="plus petit nombre de groupes essayé")
+    selection.add_argument("--nb-groupes-max", type=int,
+                           default=NB_GROUPES_MAX,
+                           help="plus grand nombre de groupes essayé")
+    selection.add_argument("--taille-echantillon", type=int,
+                           default=TAILLE_ECHANTILLON,
+                           help="nombre de films pour estimer la silhouette")
+    selection.add_argument("--nb-essais", type=int, default=NB_ESSAIS,
+                           help="nombre de k-means lancés pour chaque nombre "
+                                "de groupes")
+    selection.add_argument("--nb-processus", type=int, default=None,
+                           help="nombre de processus (défaut: un par "
+                                "processeur)")
+
+    predict = argparse.ArgumentParser(add_help=False)
+    predict.add_argument("--nb-voisins", type=int, default=NB_VOISINS,
+                         help="nombre de voisins pour prédire une note")
+    predict.add_argument("--nb-referents", type=int, default=NB_REFERENTS,
+                         help="nombre de films de note connue")
+    predict.add_argument("--tolerence", type=float, default=TOLERENCE,
+                         help="écart maximal pour une prédiction correcte")
+
+    serve = argparse.ArgumentParser(add_help=False)
+    serve.add_argument("--http", type=int, default=None, metavar="PORT",
+                       help="servir en HTTP sur ce port plutôt que de lire "
+                            "des lignes JSON sur l'entrée standard")
+    serve.add_argument("--hote", default="127.0.0.1",
+                       help="adresse d'écoute du service HTTP")
+    serve.add_argument("--taille-lot", type=int, default=32,
+                       help="nombre maximal de commentaires par lot")
+    serve.add_argument("--delai-lot", type=float, default=0.0,
+                       help="attente maximale en ms pour compléter un lot "
+                            "quand aucune requête n'attend (0: aucune)")
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sous_parsers = parser.add_subparsers(dest="commande")
+    sous_commandes = [
+        ("preprocess", commande_preprocess, [commun]),
+        ("index", commande_index, [index]),
+        ("cluster", commande_cluster, [mots, cluster]),
+        ("update", commande_update, [mots, cluster, update]),
+        ("select-k", commande_select_k, [mots, selection]),
+        ("predict", commande_predict, [mots, predict]),
+        ("all", commande_all, [mots, cluster, predict]),
+        ("serve", commande_serve, [mots, cluster, predict, serve]),
+    ]
+    for nom, fonction, parents in sous_commandes:
+        sous_parser = sous_parsers.add_parser(
+            nom, parents=parents, help=fonction.__doc__.splitlines()[0])
+        sous_parser.set_defaults(fonction=fonction)
+    return parser
+
+
+def main(argv=None):
     """Fonction principale."""
     debut = time.time()
-    asso = partie1()
-    stockeur = partie2()
-    deb = time.time()
-    mots_perti = partie3(stockeur)
-    groupes, centres = partie4(mots_perti, stockeur)
-    _afficher_groupes(groupes, centres)
-    print("Classification terminée en %.3fs." % (time.time() - deb))
-    print("Opération totale terminée en %.3fs." % (time.time() - debut))
-    bonus(stockeur, mots_perti, asso)
+    parser = creer_parser()
+    args = parser.parse_args(argv)
+    if args.commande is None:
+        # Sans sous-commande, on exécute tout avec les valeurs par défaut
+        args = parser.parse_args(["all"])
+    if args.commande == "serve" and not args.cosinus:
+        # Les vecteurs des commentaires (1 + log n) ne sont pas à l'échelle
+        # des centres (log n): seule la distance cosinus les compare
+        parser.error("le service n'accepte pas --euclidienne")
+    if args.commande == "select-k" and \
+            not 2 <= args.nb_groupes_min <= args.nb_groupes_max:
+        parser.error("il faut 2 <= --nb-groupes-min <= --nb-groupes-max")
+    try:
+        ajouter_chemins(args)
+    except IOError as erreur:
+        parser.error(str(erreur))
+    # Valeurs des options des étapes non demandées, pour déclarer le pipeline
+    for commande in ("all", "select-k"):
+        defauts = parser.parse_args([commande])
+        for option, valeur in vars(defauts).items():
+            if not hasattr(args, option):
+                setattr(args, option, valeur)
+    # Le service écrit ses réponses sur la sortie standard: les messages
+    # du programme passent alors sur la sortie d'erreur
+    args.sortie = sys.stdout
+    journal = sys.stderr if args.commande == "serve" else sys.stdout
+    with contextlib.redirect_stdout(journal):
+        pipe = construire_pipeline(args)
+        args.fonction(pipe, args)
+        print("Opération totale terminée en %.3fs." % (time.time() - debut))
+        pipe.rapport()
 
 
 if __name__ == "__main__":
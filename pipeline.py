@@ -0,0 +1,281 @@
+"""Enchaînement des étapes du programme avec mise en cache des résultats.
+
+Chaque étape déclare les étapes dont elle dépend et ses paramètres. Son
+résultat est enregistré sur le disque sous une clé calculée à partir de ses
+paramètres et des clés de ses dépendances: une étape n'est recalculée que si
+l'une de ses entrées a changé.
+
+Une étape d'empreinte résume des données extérieures au pipeline (les
+fichiers du corpus). Elle n'est pas mise en cache: sa clé est la dernière
+empreinte calculée, enregistrée sur le disque. Elle est recalculée quand sa
+signature, vérification rapide faite à chaque exécution, a changé, quand une
+étape qui en dépend doit être recalculée, ou quand elle est demandée
+directement.
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import time
+
+# A incrémenter quand la structure des objets enregistrés change, pour que
+# les résultats en cache des versions précédentes ne soient pas relus.
+VERSION_CACHE = 3
+
+
+def calculer_cle(nom, parametres, cles_dependances):
+    """Renvoie l'empreinte d'une étape.
+
+    :param nom: nom de l'étape.
+    :param parametres: dictionnaire des paramètres de l'étape, sérialisable
+                       en JSON.
+    :param cles_dependances: liste des clés des étapes dont elle dépend.
+    """
+    contenu = json.dumps([VERSION_CACHE, nom, parametres, cles_dependances],
+                         sort_keys=True)
+    return hashlib.sha256(contenu.encode('utf8')).hexdigest()
+
+
+class Etape:
+    """Une étape du programme, avec ses entrées déclarées."""
+
+    def __init__(self, nom, fonction, dependances=(), parametres=None,
+                 valide=None, empreinte=False, signature=None):
+        """Déclare une étape.
+
+        :param nom: nom unique de l'étape.
+        :param fonction: fonction appelée avec les résultats des dépendances,
+                         dans l'ordre, et la clé de l'étape.
+        :param dependances: noms des étapes dont le résultat est nécessaire.
+        :param parametres: dictionnaire des paramètres qui influent sur le
+                           résultat.
+        :param valide: fonction optionnelle appelée avec la clé, qui renvoie
+                       faux si le résultat en cache n'est plus utilisable
+                       (par exemple si des fichiers produits ont été effacés).
+        :param empreinte: si vrai, la fonction est appelée sans clé et
+                          renvoie une empreinte, chaîne qui change quand les
+                          données qu'elle résume changent.
+        :param signature: pour une étape d'empreinte, fonction optionnelle
+                          peu coûteuse appelée sans argument, qui renvoie
+                          une valeur sérialisable en JSON. L'empreinte est
+                          recalculée si la signature diffère de celle
+                          enregistrée avec elle. None si la signature ne
+                          peut pas être lue: l'empreinte enregistrée est
+                          alors gardée.
+        """
+        self.nom = nom
+        self.fonction = fonction
+        self.dependances = list(dependances)
+        self.parametres = parametres or {}
+        self.valide = valide
+        self.empreinte = empreinte
+        self.signature = signature
+
+
+class Pipeline:
+    """Exécute les étapes en ne recalculant que celles qui ont changé."""
+
+    def __init__(self, dossier_cache, forcer=False):
+        """Initialise le pipeline.
+
+        :param dossier_cache: dossier où sont stockés les résultats.
+        :param forcer: si vrai, ignorer le cache et tout recalculer.
+        """
+        self.dossier_cache = dossier_cache
+        self.forcer = forcer
+        self.etapes = {}
+        self.cles = {}
+        self.resultats = {}
+        # nom de l'étape -> vrai si le résultat vient du cache
+        self.depuis_cache = {}
+
+    def ajouter(self, etape):
+        """Ajoute une étape, ses dépendances doivent déjà être déclarées."""
+        for dependance in etape.dependances:
+            if dependance not in self.etapes:
+                raise ValueError("Etape %s inconnue (requise par %s)." %
+                                 (dependance, etape.nom))
+        self.etapes[etape.nom] = etape
+
+    def cle(self, nom):
+        """Renvoie la clé d'une étape, calculée récursivement."""
+        if nom not in self.cles:
+            etape = self.etapes[nom]
+            parametres = etape.parametres
+            if etape.empreinte:
+                parametres = dict(parametres,
+                                  empreinte=self._derniere_empreinte(nom))
+            self.cles[nom] = calculer_cle(
+                nom, parametres,
+                [self.cle(dependance) for dependance in etape.dependances])
+        return self.cles[nom]
+
+    def _cle_parametres(self, nom):
+        """Clé de l'étape sans les empreintes de ses entrées extérieures.
+
+        Elle ne change qu'avec les paramètres de l'étape et de ses
+        dépendances, pas avec le corpus.
+        """
+        etape = self.etapes[nom]
+        return calculer_cle(
+            nom, etape.parametres,
+            [self._cle_parametres(dependance)
+             for dependance in etape.dependances])
+
+    def _chemin_dernier(self, nom):
+        return os.path.join(self.dossier_cache, "%s.dernier" % nom)
+
+    def resultat_precedent(self, nom):
+        """Renvoie le dernier résultat enregistré de l'étape, ou None.
+
+        Seul un résultat calculé avec les mêmes paramètres est renvoyé,
+        éventuellement sur un autre corpus: il peut servir de point de
+        départ à une mise à jour.
+        """
+        try:
+            with open(self._chemin_dernier(nom), encoding='utf8') as fichier:
+                dernier = json.load(fichier)
+        except (OSError, ValueError):
+            return None
+        if dernier["parametres"] != self._cle_parametres(nom):
+            return None
+        chemin = os.path.join(self.dossier_cache, "%s-%s.pickle" %
+                              (nom, dernier["cle"][:16]))
+        if not os.path.exists(chemin):
+            return None
+        with open(chemin, 'rb') as fichier:
+            return pickle.load(fichier)
+
+    def enregistrer(self, nom, resultat):
+        """Enregistre le résultat d'une étape calculé hors du pipeline.
+
+        Il est mis en cache sous la clé actuelle de l'étape, comme s'il
+        avait été calculé par sa fonction.
+        """
+        self._enregistrer(nom, resultat)
+        self.depuis_cache[nom] = False
+        self.resultats[nom] = resultat
+
+    def _chemin_empreinte(self, nom):
+        return os.path.join(self.dossier_cache, "%s.empreinte" % nom)
+
+    def _lire_empreinte(self, nom):
+        """Renvoie l'empreinte et la signature enregistrées, ou None."""
+        try:
+            with open(self._chemin_empreinte(nom), encoding='utf8') as fichier:
+                return json.load(fichier)
+        except (OSError, ValueError):
+            return None
+
+    def _derniere_empreinte(self, nom):
+        """Renvoie l'empreinte enregistrée, recalculée si elle manque ou si
+        la signature a changé."""
+        if nom in self.resultats:
+            return self.resultats[nom]
+        etape = self.etapes[nom]
+        enregistrement = self._lire_empreinte(nom)
+        if self.forcer or enregistrement is None:
+            return self.executer(nom)
+        if etape.signature is not None:
+            signature = etape.signature()
+            if signature is not None and \
+                    signature != enregistrement["signature"]:
+                return self.executer(nom)
+        return enregistrement["empreinte"]
+
+    def _calculer_empreinte(self, nom):
+        """Recalcule une étape d'empreinte et enregistre le résultat.
+
+        Si l'empreinte a changé, les clés déjà calculées sont oubliées.
+        """
+        etape = self.etapes[nom]
+        entrees = [self.executer(dep) for dep in etape.dependances]
+        print("Etape %s: calcul." % nom)
+        debut = time.time()
+        # Lue avant l'empreinte: un changement pendant le calcul sera vu
+        # à la prochaine exécution
+        signature = etape.signature() if etape.signature else None
+        empreinte = etape.fonction(*entrees)
+        os.makedirs(self.dossier_cache, exist_ok=True)
+        chemin = self._chemin_empreinte(nom)
+        with open(chemin + ".tmp", 'w', encoding='utf8') as fichier:
+            json.dump({"empreinte": empreinte, "signature": signature},
+                      fichier)
+        os.replace(chemin + ".tmp", chemin)
+        print("Etape %s: calculée en %.3fs." % (nom, time.time() - debut))
+        self.depuis_cache[nom] = False
+        self.resultats[nom] = empreinte
+        self.cles = {}
+        return empreinte
+
+    def _chemin(self, nom):
+        return os.path.join(self.dossier_cache,
+                            "%s-%s.pickle" % (nom, self.cle(nom)[:16]))
+
+    def _charger(self, nom):
+        """Renvoie (vrai, résultat) si l'étape est en cache, (faux, None)."""
+        etape = self.etapes[nom]
+        chemin = self._chemin(nom)
+        if self.forcer or not os.path.exists(chemin):
+            return False, None
+        if etape.valide is not None and not etape.valide(self.cle(nom)):
+            return False, None
+        with open(chemin, 'rb') as fichier:
+            return True, pickle.load(fichier)
+
+    def _enregistrer(self, nom, resultat):
+        os.makedirs(self.dossier_cache, exist_ok=True)
+        chemin = self._chemin(nom)
+        # Ecriture dans un fichier temporaire pour ne jamais laisser de
+        # résultat partiel si le programme est interrompu
+        temporaire = chemin + ".tmp"
+        with open(temporaire, 'wb') as fichier:
+            pickle.dump(resultat, fichier, pickle.HIGHEST_PROTOCOL)
+        os.replace(temporaire, chemin)
+        # Dernier résultat de l'étape, pour `resultat_precedent`
+        with open(self._chemin_dernier(nom) + ".tmp", 'w',
+                  encoding='utf8') as fichier:
+            json.dump({"cle": self.cle(nom),
+                       "parametres": self._cle_parametres(nom)}, fichier)
+        os.replace(self._chemin_dernier(nom) + ".tmp",
+                   self._chemin_dernier(nom))
+
+    def executer(self, nom):
+        """Renvoie le résultat d'une étape, en calculant le nécessaire.
+
+        Une étape en cache ne demande pas le résultat de ses dépendances.
+        """
+        if nom in self.resultats:
+            return self.resultats[nom]
+        etape = self.etapes[nom]
+        if etape.empreinte:
+            return self._calculer_empreinte(nom)
+        trouve, resultat = self._charger(nom)
+        if not trouve:
+            cle = self.cle(nom)
+            entrees = [self.executer(dep) for dep in etape.dependances]
+            if self.cle(nom) != cle:
+                # Une empreinte a changé: le résultat est peut-être en cache
+                # sous la nouvelle clé
+                trouve, resultat = self._charger(nom)
+        if trouve:
+            print("Etape %s: en cache." % nom)
+        else:
+            print("Etape %s: calcul." % nom)
+            debut = time.time()
+            resultat = etape.fonction(*entrees, self.cle(nom))
+            self._enregistrer(nom, resultat)
+            print("Etape %s: calculée en %.3fs." % (nom, time.time() - debut))
+        self.depuis_cache[nom] = trouve
+        self.resultats[nom] = resultat
+        return resultat
+
+    def rapport(self):
+        """Affiche, pour chaque étape exécutée, si le cache a été utilisé."""
+        print("Etapes en cache: %s" % ", ".join(
+            [nom for nom, cache in self.depuis_cache.items() if cache]
+            or ["aucune"]))
+        print("Etapes recalculées: %s" % ", ".join(
+            [nom for nom, cache in self.depuis_cache.items() if not cache]
+            or ["aucune"]))
@@ -0,0 +1,230 @@
+"""Stockage compact des vecteurs des films et des centres.
+
+Un vecteur {mot: indice} est remplacé par deux tableaux: les identifiants
+triés des mots et leurs valeurs, en flottants 32 bits ou en entiers 8 bits
+avec un facteur d'échelle par vecteur. Les distances sont calculées
+directement sur ces tableaux.
+"""
+
+import functools
+import math
+import random
+import sys
+import tracemalloc
+from array import array
+from bisect import bisect_left
+
+import analyse
+import classification
+import voisins
+
+PRECISIONS = ("float64", "float32", "int8")
+
+
+class VecteurQuantifie(analyse.VecteurIdentifiants):
+    """Vecteur creux stocké en float32 ou en int8 avec une échelle.
+
+    Se lit comme un dictionnaire {mot: valeur}, les valeurs étant
+    déquantifiées à la lecture.
+    """
+
+    __slots__ = ("vocabulaire", "ids", "valeurs", "echelle", "norme")
+
+    def __init__(self, vocabulaire, dico, precision):
+        """Quantifie un dictionnaire.
+
+        :param vocabulaire: objet analyse.Vocabulaire partagé par tous les
+                            vecteurs à comparer.
+        :param precision: "float32" ou "int8".
+        """
+        self.vocabulaire = vocabulaire
+        identifiant = vocabulaire.identifiant
+        par_id = {identifiant(mot): valeur for mot, valeur in dico.items()}
+        self.ids = array('I', sorted(par_id))
+        valeurs = [par_id[ident] for ident in self.ids]
+        if precision == "float32":
+            self.echelle = 1.0
+            self.valeurs = array('f', valeurs)
+        elif precision == "int8":
+            maximum = max(map(abs, valeurs), default=0.0)
+            self.echelle = maximum / 127 if maximum > 0 else 1.0
+            self.valeurs = array('b', [round(valeur / self.echelle)
+                                       for valeur in valeurs])
+        else:
+            raise ValueError("Précision inconnue: %s" % precision)
+        # Norme au carré des valeurs quantifiées, sans l'échelle
+        self.norme = sum(valeur * valeur for valeur in self.valeurs)
+
+    def __getitem__(self, mot):
+        rang = self._rang(mot)
+        if rang < 0:
+            raise KeyError(mot)
+        return self.valeurs[rang] * self.echelle
+
+    def items(self):
+        mots = self.vocabulaire.mots
+        echelle = self.echelle
+        return ((mots[ident], valeur * echelle)
+                for ident, valeur in zip(self.ids, self.valeurs))
+
+    def produit_scalaire(self, autre):
+        """Produit scalaire des valeurs quantifiées, sans les échelles.
+
+        Parcourt le plus court des deux vecteurs et cherche ses mots dans
+        l'autre par dichotomie.
+        """
+        if len(self) > len(autre):
+            return autre.produit_scalaire(self)
+        ids_long, valeurs_long = autre.ids, autre.valeurs
+        taille = len(ids_long)
+        produit = 0
+        debut = 0
+        for ident, valeur in zip(self.ids, self.valeurs):
+            debut = bisect_left(ids_long, ident, debut)
+            if debut == taille:
+                break
+            if ids_long[debut] == ident:
+                produit += valeur * valeurs_long[debut]
+        return produit
+
+    def distance(self, autre, cosinus=True):
+        """Distance cosinus ou euclidienne au carré avec un autre vecteur
+        quantifié sur le même vocabulaire."""
+        produit = self.produit_scalaire(autre) * self.echelle * autre.echelle
+        norme_prm = self.norme * self.echelle * self.echelle
+        norme_sec = autre.norme * autre.echelle * autre.echelle
+        if cosinus:
+            denom = math.sqrt(norme_prm * norme_sec)
+            if denom != 0.0:
+                return 1.0 - produit / denom
+            return 1.0
+        return max(0.0, norme_prm + norme_sec - 2 * produit)
+
+
+class StockeurQuantifie(analyse.StockeurTransforme):
+    """Présente les vecteurs quantifiés avec l'interface du stockeur TF-IDF."""
+
+    def __init__(self, stockeur_indices, precision):
+        """:param stockeur_indices: stockeur dont les vecteurs sont lus."""
+        super().__init__(stockeur_indices)
+        self.precision = precision
+        self.vocabulaire = analyse.Vocabulaire()
+
+    def quantifier(self, dico):
+        """Renvoie le vecteur quantifié d'un dictionnaire {mot: valeur}."""
+        return VecteurQuantifie(self.vocabulaire, dico, self.precision)
+
+    transformer = quantifier
+
+    def quantificateur(self):
+        """Renvoie une fonction équivalente à `quantifier`.
+
+        Elle ne garde que le vocabulaire et la précision, pas le stockeur:
+        elle reste légère à copier dans d'autres processus.
+        """
+        return functools.partial(VecteurQuantifie, self.vocabulaire,
+                                 precision=self.precision)
+
+
+def quantifier_stockeur(stockeur_indices, precision):
+    """Renvoie le stockeur à utiliser pour la précision demandée."""
+    if precision == "float64":
+        return stockeur_indices
+    return StockeurQuantifie(stockeur_indices, precision)
+
+
+def memoire_vecteurs(stockeur_indices, films, mots_pertinents):
+    """Calcule les vecteurs des films et mesure la mémoire qu'ils occupent.
+
+    La mesure est faite avec tracemalloc, sur tout ce que le stockeur garde
+    en mémoire pendant le calcul. Les vecteurs restent dans son cache.
+    Renvoie le nombre d'octets.
+    """
+    deja_actif = tracemalloc.is_tracing()
+    if not deja_actif:
+        tracemalloc.start()
+    avant = tracemalloc.get_traced_memory()[0]
+    for film in films:
+        stockeur_indices.get_indices_tfidf_mots_filtres(film, mots_pertinents)
+    memoire = tracemalloc.get_traced_memory()[0] - avant
+    if not deja_actif:
+        tracemalloc.stop()
+    return memoire
+
+
+def pic_memoire_processus():
+    """Renvoie le pic de mémoire résidente du processus en Ko.
+
+    None si le système ne le donne pas (Windows).
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    pic = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # En octets sous macOS, en Ko ailleurs
+    return pic // 1024 if sys.platform == "darwin" else pic
+
+
+def rapport_classification(films, centres, mots_pertinents, distance_cosinus,
+                           stockeur_complet, stockeur_quantifie):
+    """Compare la classification quantifiée à la pleine précision.
+
+    Chaque film est affecté au centre le plus proche avec les deux
+    représentations, à partir des mêmes centres. Les vecteurs en pleine
+    précision ne sont pas gardés.
+
+    Renvoie la proportion de films affectés au même groupe.
+    """
+    centres_complets = [dict(centre.items()) for centre in centres]
+    centres_quantifies = [stockeur_quantifie.quantifier(centre)
+                          for centre in centres_complets]
+    identiques = 0
+    for film in films:
+        complet = stockeur_complet.calculer_indices_tfidf_mots_filtres(
+            film, mots_pertinents)
+        quantifie = stockeur_quantifie.get_indices_tfidf_mots_filtres(
+            film, mots_pertinents)
+        groupe_complet, _ = classification.plus_proche_centre(
+            complet, centres_complets, distance_cosinus)
+        groupe_quantifie, _ = classification.plus_proche_centre(
+            quantifie, centres_quantifies, distance_cosinus)
+        identiques += groupe_complet == groupe_quantifie
+    return identiques / max(1, len(films))
+
+
+def rapport_notes(films, nb_proches, nb_ref, mots_pertinents, moyennes,
+                  stockeur_complet, stockeur_quantifie, nb_films=200):
+    """Compare les notes prédites en pleine précision et quantifiées.
+
+    Les mêmes référents sont utilisés pour les deux prédictions, sur un
+    échantillon de `nb_films` films.
+
+    Renvoie (écart absolu moyen entre les deux prédictions, proportion de
+    films dont les voisins sont identiques).
+    """
+    # Les vecteurs en pleine précision sont calculés sans être gardés par
+    # le stockeur
+    references = {
+        ref: stockeur_complet.calculer_indices_tfidf_mots_filtres(
+            ref, mots_pertinents)
+        for ref in voisins.referents(nb_ref, films)}
+    references_quantifiees = {
+        ref: stockeur_quantifie.get_indices_tfidf_mots_filtres(
+            ref, mots_pertinents) for ref in references}
+    autres = [film for film in films if film not in references]
+    echantillon = random.sample(autres, min(nb_films, len(autres)))
+    ecart = 0.0
+    memes_voisins = 0
+    for film in echantillon:
+        proches = voisins.plus_proches_vecteur(
+            stockeur_complet.calculer_indices_tfidf_mots_filtres(
+                film, mots_pertinents), nb_proches, references)
+        proches_quantifies = voisins.plus_proches_vecteur(
+            stockeur_quantifie.get_indices_tfidf_mots_filtres(
+                film, mots_pertinents), nb_proches, references_quantifiees)
+        memes_voisins += set(proches) == set(proches_quantifies)
+        ecart += abs(voisins.note_ponderee(proches, moyennes) -
+                     voisins.note_ponderee(proches_quantifies, moyennes))
+    nb_films = max(1, len(echantillon))
+    return ecart / nb_films, memes_voisins / nb_films
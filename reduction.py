@@ -0,0 +1,79 @@
+"""Réduction de dimension des vecteurs TF-IDF.
+
+Les vecteurs des films, indexés par les mots pertinents, sont projetés sur
+un petit nombre de dimensions par une projection aléatoire creuse (Li,
+Hastie et Church, 2006): chaque mot contribue à quelques dimensions avec un
+coefficient ±sqrt(s/k). Les distances sont conservées en moyenne, et le coût
+du k-means et des plus proches voisins ne dépend plus du nombre de mots.
+"""
+
+import math
+import random
+import zlib
+
+import analyse
+
+
+class Projection:
+    """Projection aléatoire creuse des mots pertinents vers k dimensions."""
+
+    def __init__(self, mots_pertinents, dimensions, graine=0):
+        """Tire la ligne de la matrice de projection de chaque mot.
+
+        La ligne d'un mot ne dépend que du mot et de la graine: la même
+        projection s'applique aux nouveaux films.
+
+        :param mots_pertinents: mots utilisés pour la classification.
+        :param dimensions: nombre de dimensions après projection.
+        :param graine: graine du tirage des coefficients.
+        """
+        self.dimensions = dimensions
+        self.graine = graine
+        # Une case sur s est non nulle, avec s = racine du nombre de mots
+        self.rarete = max(1.0, math.sqrt(len(mots_pertinents)))
+        self.lignes = {mot: self._ligne(mot) for mot in mots_pertinents}
+
+    def _ligne(self, mot):
+        """Renvoie la liste des (dimension, coefficient) non nuls d'un mot."""
+        tirage = random.Random(zlib.crc32(mot.encode('utf8')) ^ self.graine)
+        coefficient = math.sqrt(self.rarete / self.dimensions)
+        ligne = []
+        for dimension in range(self.dimensions):
+            valeur = tirage.random() * self.rarete
+            if valeur < 0.5:
+                ligne.append((dimension, -coefficient))
+            elif valeur < 1:
+                ligne.append((dimension, coefficient))
+        return ligne
+
+    def projeter(self, dico):
+        """Renvoie le vecteur projeté {dimension: valeur} d'un film.
+
+        :param dico: dictionnaire {mot: indice}, les mots absents de la
+                     projection sont ignorés.
+        """
+        resultat = {}
+        for mot, indice in dico.items():
+            for dimension, coefficient in self.lignes.get(mot, ()):
+                resultat[dimension] = (resultat.get(dimension, 0.0) +
+                                       coefficient * indice)
+        return resultat
+
+
+class StockeurReduit(analyse.StockeurTransforme):
+    """Présente les vecteurs projetés avec l'interface du stockeur TF-IDF."""
+
+    def __init__(self, stockeur_indices, projection):
+        """:param stockeur_indices: objet StockeurIndicesTfIdf complet."""
+        super().__init__(stockeur_indices)
+        self.projection = projection
+
+    def transformer(self, dico):
+        return self.projection.projeter(dico)
+
+
+def reduire(stockeur_indices, projection):
+    """Renvoie le stockeur à utiliser, réduit si une projection est donnée."""
+    if projection is None:
+        return stockeur_indices
+    return StockeurReduit(stockeur_indices, projection)
@@ -0,0 +1,451 @@
+"""Service de classification et de notation de nouveaux commentaires.
+
+Le modèle (vocabulaire, indices IDF, centres des groupes et films de
+référence) est chargé une seule fois. Les commentaires arrivent en JSON, par
+l'entrée standard (un objet par ligne) ou en HTTP, et sont traités par lots
+pour regrouper les requêtes simultanées.
+"""
+
+import collections
+import heapq
+import json
+import math
+import queue
+import random
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import analyse
+import classification
+import voisins
+
+
+class Modele:
+    """Tout ce qu'il faut pour classer et noter un commentaire brut."""
+
+    def __init__(self, mots_pertinents, idf, centres, vecteurs_references,
+                 moyennes, nb_voisins, distance_cosinus, projection=None):
+        """Initialise le modèle.
+
+        :param mots_pertinents: ensemble des mots utilisés pour classer.
+        :param idf: dictionnaire mot -> indice IDF des mots pertinents.
+        :param centres: liste des centres des groupes du k-means.
+        :param vecteurs_references: dictionnaire film -> indices TF-IDF des
+                                    films dont la note est connue.
+        :param moyennes: dictionnaire film -> note moyenne.
+        :param projection: objet reduction.Projection appliqué aux textes si
+                           les centres et les références sont réduits.
+        """
+        self.mots_pertinents = mots_pertinents
+        self.idf = idf
+        self.centres = centres
+        self.vecteurs_references = vecteurs_references
+        self.moyennes = moyennes
+        self.nb_voisins = nb_voisins
+        self.distance_cosinus = distance_cosinus
+        self.projection = projection
+        self._traiteur = None
+        self._index = None
+
+    def __getstate__(self):
+        # Le lemmatiseur et les index ne sont pas enregistrés, ils sont
+        # recréés au chargement
+        etat = self.__dict__.copy()
+        etat["_traiteur"] = None
+        etat["_index"] = None
+        return etat
+
+    @property
+    def traiteur(self):
+        """Nettoyeur des commentaires, créé à la première utilisation.
+
+        Il garde en cache les lemmes déjà calculés.
+        """
+        if self._traiteur is None:
+            import traitement
+            self._traiteur = traitement.TraiteurCommentaire()
+        return self._traiteur
+
+    def vectoriser(self, commentaire):
+        """Renvoie les indices TF-IDF des mots pertinents d'un texte brut."""
+        return self.vectoriser_lot([commentaire])[0]
+
+    def vectoriser_lot(self, commentaires):
+        """Renvoie les vecteurs d'une liste de textes bruts."""
+        textes = self.traiteur.traiter_commentaires(
+            [commentaire.strip() for commentaire in commentaires])
+        vecteurs = []
+        for texte in textes:
+            compte = analyse.compter_occurences(texte.split())
+            # Un commentaire seul contient la plupart de ses mots une seule
+            # fois: log(1) = 0 annulerait le vecteur, on prend 1 + log(n)
+            nb_mots = len(compte)
+            vecteur = {mot: (1 + math.log(nb)) / nb_mots * self.idf[mot]
+                       for mot, nb in compte.items()
+                       if mot in self.mots_pertinents}
+            if self.projection is not None:
+                vecteur = self.projection.projeter(vecteur)
+            vecteurs.append(vecteur)
+        return vecteurs
+
+    def _cibles(self):
+        """Index inversés des centres et des films de référence.
+
+        Calculés à la première prédiction: (index des centres, normes des
+        centres, films de référence, index des références, normes des
+        références), un index associant à chaque mot la liste des couples
+        (rang du vecteur, indice).
+        """
+        if self._index is None:
+            films = list(self.vecteurs_references)
+            self._index = (
+                _index_inverse(self.centres) +
+                (films,) +
+                _index_inverse([self.vecteurs_references[film]
+                                for film in films]))
+        return self._index
+
+    def predire(self, commentaires):
+        """Renvoie le groupe et la note estimée de chaque commentaire.
+
+        Le groupe et la note valent None si le commentaire ne contient
+        aucun mot pertinent, la note seule si aucun voisin n'est assez
+        proche. Un commentaire qui échoue donne l'exception à sa place dans
+        la liste, sans empêcher le traitement des autres.
+        """
+        try:
+            return self._predire_lot(commentaires)
+        except Exception as erreur:
+            if len(commentaires) == 1:
+                return [erreur]
+        # Un commentaire fait échouer le lot: on les reprend un par un
+        return [self.predire([commentaire])[0] for commentaire in commentaires]
+
+    def _predire_lot(self, commentaires):
+        """Traite tout le lot d'un bloc: les mots distincts sont lemmatisés
+        une fois et les distances aux centres et aux références calculées
+        en un seul passage."""
+        resultats = [None] * len(commentaires)
+        textes = {}
+        for rang, commentaire in enumerate(commentaires):
+            if isinstance(commentaire, str):
+                textes[rang] = commentaire
+            else:
+                resultats[rang] = TypeError(
+                    "Le texte doit être une chaîne, pas %s"
+                    % type(commentaire).__name__)
+        vecteurs = self.vectoriser_lot(list(textes.values()))
+        (index_centres, normes_centres, films,
+         index_references, normes_references) = self._cibles()
+        distances_centres = _distances_lot(
+            vecteurs, index_centres, normes_centres, self.distance_cosinus)
+        distances_references = _distances_lot(
+            vecteurs, index_references, normes_references, True)
+        for rang, vecteur, vers_centres, vers_references in zip(
+                textes, vecteurs, distances_centres, distances_references):
+            if not any(vecteur.values()):
+                resultats[rang] = {"groupe": None, "note": None}
+                continue
+            groupe = min(range(len(vers_centres)),
+                         key=vers_centres.__getitem__)
+            plus_pres = dict(heapq.nsmallest(
+                self.nb_voisins, zip(films, vers_references),
+                key=lambda couple: couple[1]))
+            note = voisins.note_ponderee(plus_pres, self.moyennes)
+            resultats[rang] = {"groupe": groupe,
+                               "note": round(note, 2) if note >= 0 else None}
+        return resultats
+
+
+def _index_inverse(vecteurs):
+    """Renvoie l'index mot -> [(rang, indice)] et les normes au carré."""
+    index = {}
+    normes = []
+    for rang, vecteur in enumerate(vecteurs):
+        norme = 0.0
+        for mot, valeur in vecteur.items():
+            index.setdefault(mot, []).append((rang, valeur))
+            norme += valeur * valeur
+        normes.append(norme)
+    return index, normes
+
+
+def _distances_lot(vecteurs, index, normes, distance_cosinus):
+    """Renvoie la matrice des distances entre un lot de vecteurs et les
+    vecteurs indexés.
+
+    Les listes de l'index ne sont parcourues qu'une fois par mot distinct
+    du lot. La distance est 1 - cosinus, ou le carré de la distance
+    euclidienne, comme dans le module distance.
+    """
+    produits = [[0.0] * len(normes) for _ in vecteurs]
+    par_mot = {}
+    for rang, vecteur in enumerate(vecteurs):
+        for mot, valeur in vecteur.items():
+            par_mot.setdefault(mot, []).append((rang, valeur))
+    for mot, occurrences in par_mot.items():
+        liste = index.get(mot)
+        if liste is None:
+            continue
+        for rang, valeur in occurrences:
+            ligne = produits[rang]
+            for rang_cible, valeur_cible in liste:
+                ligne[rang_cible] += valeur * valeur_cible
+    distances = []
+    for vecteur, ligne in zip(vecteurs, produits):
+        norme = sum(valeur * valeur for valeur in vecteur.values())
+        if distance_cosinus:
+            distances.append([
+                1 - produit / math.sqrt(norme * norme_cible)
+                if norme * norme_cible > 0 else 1.0
+                for produit, norme_cible in zip(ligne, normes)])
+        else:
+            distances.append([
+                max(0.0, norme + norme_cible - 2 * produit)
+                for produit, norme_cible in zip(ligne, normes)])
+    return distances
+
+
+def construire_modele(stockeur_indices, mots_pertinents, centres, moyennes,
+                      nb_referents, nb_voisins, distance_cosinus,
+                      projection=None):
+    """Extrait du corpus le modèle nécessaire au service.
+
+    Les films de référence sont tirés au hasard parmi ceux qui ont une note
+    et au moins un mot pertinent. Seule la distance cosinus est acceptée:
+    un commentaire seul n'est pas à l'échelle des vecteurs des films.
+    """
+    if not distance_cosinus:
+        raise ValueError("Le service demande la distance cosinus.")
+    idf = {mot: stockeur_indices.get_idf_mot(mot) for mot in mots_pertinents}
+    films = [film for film in classification.filtrer_films_non_vides(
+        stockeur_indices.get_films(), mots_pertinents,
+        stockeur_indices) if film in moyennes]
+    references = random.sample(films, min(nb_referents, len(films)))
+    vecteurs_references = {
+        film: stockeur_indices.get_indices_tfidf_mots_filtres(
+            film, mots_pertinents) for film in references}
+    return Modele(set(mots_pertinents), idf, centres, vecteurs_references,
+                  {film: moyennes[film] for film in references},
+                  nb_voisins, distance_cosinus, projection)
+
+
+def centile(valeurs, proportion):
+    """Renvoie le centile d'une liste de valeurs non vide."""
+    triees = sorted(valeurs)
+    rang = max(0, math.ceil(proportion * len(triees)) - 1)
+    return triees[rang]
+
+
+class Regroupeur:
+    """Regroupe les requêtes simultanées en lots traités ensemble."""
+
+    def __init__(self, modele, taille_lot=32, delai=0.0):
+        """Démarre le fil qui traite les lots.
+
+        :param taille_lot: nombre maximal de commentaires par lot.
+        :param delai: temps maximal en secondes pour compléter un lot
+                      quand la file est vide, 0 pour ne pas attendre.
+        """
+        self.modele = modele
+        self.taille_lot = taille_lot
+        self.delai = delai
+        self.file = queue.Queue()
+        # Latences des dernières requêtes, en secondes
+        self.latences = collections.deque(maxlen=10000)
+        self.nb_requetes = 0
+        self.fil = threading.Thread(target=self._boucle, daemon=True)
+        self.fil.start()
+
+    def soumettre(self, commentaire):
+        """Renvoie un objet Future qui recevra le résultat."""
+        futur = Future()
+        self.file.put((commentaire, futur, time.perf_counter()))
+        return futur
+
+    def arreter(self):
+        """Termine les lots en cours et arrête le fil."""
+        self.file.put(None)
+        self.fil.join()
+
+    def _lot_suivant(self):
+        """Attend une requête puis complète le lot.
+
+        Les requêtes arrivées pendant le traitement du lot précédent sont
+        prises sans attendre. Si la file est vide, le lot part aussitôt,
+        sauf si un délai est donné: on attend alors au plus ce délai.
+        """
+        premier = self.file.get()
+        if premier is None:
+            return None
+        lot = [premier]
+        limite = time.perf_counter() + self.delai
+        while len(lot) < self.taille_lot:
+            reste = limite - time.perf_counter()
+            try:
+                if reste > 0:
+                    requete = self.file.get(timeout=reste)
+                else:
+                    requete = self.file.get_nowait()
+            except queue.Empty:
+                break
+            if requete is None:
+                # On traite le lot avant de s'arrêter
+                self.file.put(None)
+                break
+            lot.append(requete)
+        return lot
+
+    def _boucle(self):
+        while True:
+            lot = self._lot_suivant()
+            if lot is None:
+                return
+            resultats = self.modele.predire([com for com, _, _ in lot])
+            fin = time.perf_counter()
+            for (_, futur, debut), resultat in zip(lot, resultats):
+                self.latences.append(fin - debut)
+                if isinstance(resultat, Exception):
+                    futur.set_exception(resultat)
+                else:
+                    futur.set_result(resultat)
+            self.nb_requetes += len(lot)
+
+    def statistiques(self):
+        """Renvoie le nombre de requêtes et les latences p50 et p99 en ms."""
+        latences = list(self.latences)
+        if not latences:
+            return {"requetes": self.nb_requetes}
+        return {"requetes": self.nb_requetes,
+                "p50_ms": round(1000 * centile(latences, 0.5), 3),
+                "p99_ms": round(1000 * centile(latences, 0.99), 3)}
+
+
+def _afficher_statistiques(regroupeur):
+    stats = regroupeur.statistiques()
+    print("%d requêtes traitées." % stats["requetes"], file=sys.stderr)
+    if "p50_ms" in stats:
+        print("Latence p50: %.3fms\tp99: %.3fms" %
+              (stats["p50_ms"], stats["p99_ms"]), file=sys.stderr)
+
+
+def _texte_requete(requete):
+    """Renvoie le texte d'une requête décodée, qui doit être une chaîne."""
+    texte = requete["texte"]
+    if not isinstance(texte, str):
+        raise TypeError("'texte' doit être une chaîne, pas %s"
+                        % type(texte).__name__)
+    return texte
+
+
+def servir_flux(regroupeur, entree, sortie):
+    """Lit un objet JSON par ligne et écrit les réponses dans le même ordre.
+
+    Chaque objet contient le texte sous la clé "texte", et éventuellement un
+    "id" recopié dans la réponse. Les lignes sont soumises sans attendre les
+    réponses, ce qui permet de les traiter par lots.
+    """
+    en_attente = queue.Queue(maxsize=4 * regroupeur.taille_lot)
+
+    def ecrire():
+        while True:
+            element = en_attente.get()
+            if element is None:
+                return
+            identifiant, futur = element
+            try:
+                reponse = futur.result()
+            except Exception as erreur:
+                reponse = {"erreur": str(erreur)}
+            if identifiant is not None:
+                reponse = dict(reponse, id=identifiant)
+            sortie.write(json.dumps(reponse) + "\n")
+            sortie.flush()
+
+    ecrivain = threading.Thread(target=ecrire)
+    ecrivain.start()
+    for ligne in entree:
+        if not ligne.strip():
+            continue
+        futur = Future()
+        identifiant = None
+        try:
+            requete = json.loads(ligne)
+            identifiant = requete.get("id")
+            futur = regroupeur.soumettre(_texte_requete(requete))
+        except (ValueError, KeyError, AttributeError, TypeError) as erreur:
+            futur.set_exception(ValueError("Requête invalide: %s" % erreur))
+        en_attente.put((identifiant, futur))
+    en_attente.put(None)
+    ecrivain.join()
+    regroupeur.arreter()
+    _afficher_statistiques(regroupeur)
+
+
+class _GestionnaireHttp(BaseHTTPRequestHandler):
+    """POST /predire avec {"texte": ...}, GET /statistiques."""
+
+    def _repondre(self, code, contenu):
+        corps = json.dumps(contenu).encode('utf8')
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(corps)))
+        self.end_headers()
+        self.wfile.write(corps)
+
+    def do_GET(self):
+        if self.path == "/statistiques":
+            self._repondre(200, self.server.regroupeur.statistiques())
+        else:
+            self._repondre(404, {"erreur": "Chemin inconnu: %s" % self.path})
+
+    def do_POST(self):
+        if self.path != "/predire":
+            self._repondre(404, {"erreur": "Chemin inconnu: %s" % self.path})
+            return
+        try:
+            longueur = int(self.headers.get("Content-Length", 0))
+            texte = _texte_requete(json.loads(self.rfile.read(longueur)))
+        except (ValueError, KeyError, TypeError, AttributeError) as erreur:
+            self._repondre(400, {"erreur": "Requête invalide: %s" % erreur})
+            return
+        try:
+            resultat = self.server.regroupeur.soumettre(texte).result()
+        except Exception as erreur:
+            self._repondre(500, {"erreur": str(erreur)})
+            return
+        self._repondre(200, resultat)
+
+    def log_message(self, format, *args):
+        # Pas de ligne de journal par requête
+        pass
+
+
+def _interrompre(signal_recu, cadre):
+    raise KeyboardInterrupt
+
+
+def servir_http(regroupeur, hote, port):
+    """Sert les prédictions en HTTP jusqu'à une interruption.
+
+    SIGTERM est traité comme une interruption clavier pour afficher les
+    statistiques quand le service est arrêté par un superviseur.
+    """
+    signal.signal(signal.SIGTERM, _interrompre)
+    serveur = ThreadingHTTPServer((hote, port), _GestionnaireHttp)
+    serveur.daemon_threads = True
+    serveur.regroupeur = regroupeur
+    print("Service à l'écoute sur http://%s:%d" % serveur.server_address[:2],
+          file=sys.stderr)
+    try:
+        serveur.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        serveur.server_close()
+        regroupeur.arreter()
+        _afficher_statistiques(regroupeur)
@@ -4,15 +4,20 @@ Pour chaque commentaire, lemmatiser les mots et écrire le résultat dans le
 fichier du film qui lui correspond.
 """
 
+import filecmp
+import mmap
 import os
 import re
 import shutil
+import string
+import struct
 import sys
 import time
-import string
 
-from nltk.corpus import wordnet
-from nltk.stem import WordNetLemmatizer
+import lecture
+
+# Nombre maximal de lemmes gardés en cache par TraiteurCommentaire
+TAILLE_CACHE_LEMMES = 100000
 
 
 class AssociateurCommentairesFilms:
@@ -58,12 +63,190 @@ class AssociateurCommentairesFilms:
         raise IndexError("Le film %s n'a pas de titre." % film_id)
 
 
+# Format de l'index binaire, tous les entiers en petit-boutiste:
+# - en-tête: signature, version, nombre de commentaires, nombre de films
+# - commentaires: (identifiant, rang du film), triés par identifiant
+# - films: (début et longueur de l'identifiant, début et longueur du titre
+#   dans la table des chaînes), triés par identifiant
+# - table des chaînes en utf8
+SIGNATURE_INDEX = b"CTIX"
+VERSION_INDEX = 1
+_ENTETE = struct.Struct("<4sIII")
+_COMMENTAIRE = struct.Struct("<II")
+_FILM = struct.Struct("<IIII")
+
+
+def _identifiant_binaire(comment_id):
+    """Renvoie l'entier stocké pour un identifiant de commentaire.
+
+    Seule l'écriture décimale sans zéro initial d'un entier sur 32 bits
+    est acceptée: "007" et "7" ne peuvent pas être confondus.
+    Renvoie None pour tout autre identifiant.
+    """
+    texte = str(comment_id)
+    if not (texte.isascii() and texte.isdigit()) or \
+            (texte[0] == "0" and len(texte) > 1):
+        return None
+    valeur = int(texte)
+    if valeur >= 1 << 32:
+        return None
+    return valeur
+
+
+def compiler_index(path_to_index, path_to_binaire):
+    """Compile le fichier d'index texte en index binaire.
+
+    Les identifiants de commentaires doivent être des entiers positifs
+    sur 32 bits, écrits sans zéro initial.
+
+    :param path_to_index: chemin vers le fichier d'index texte.
+    :param path_to_binaire: chemin du fichier binaire à écrire.
+    """
+    comment_film = {}
+    film_titre = {}
+    with open(path_to_index, 'r', encoding='utf8') as index:
+        for ligne in index:
+            vals = ligne.split(':')
+            comment_id = _identifiant_binaire(vals[0])
+            if comment_id is None:
+                raise ValueError("Identifiant de commentaire invalide pour "
+                                 "l'index binaire: %s" % vals[0])
+            comment_film[comment_id] = vals[1].encode('utf8')
+            film_titre[vals[1].encode('utf8')] = vals[2].strip().encode('utf8')
+    films = sorted(film_titre)
+    rangs = {film: rang for rang, film in enumerate(films)}
+
+    chaines = bytearray()
+    table_films = bytearray()
+    for film in films:
+        titre = film_titre[film]
+        table_films += _FILM.pack(len(chaines), len(film),
+                                  len(chaines) + len(film), len(titre))
+        chaines += film + titre
+    table_commentaires = bytearray()
+    for comment_id in sorted(comment_film):
+        table_commentaires += _COMMENTAIRE.pack(
+            comment_id, rangs[comment_film[comment_id]])
+
+    temporaire = path_to_binaire + ".tmp"
+    with open(temporaire, 'wb') as binaire:
+        binaire.write(_ENTETE.pack(SIGNATURE_INDEX, VERSION_INDEX,
+                                   len(comment_film), len(films)))
+        binaire.write(table_commentaires)
+        binaire.write(table_films)
+        binaire.write(chaines)
+    os.replace(temporaire, path_to_binaire)
+
+
+class AssociateurIndexBinaire:
+    """Associe commentaires et films à partir de l'index binaire.
+
+    Le fichier est projeté en mémoire et les recherches sont dichotomiques:
+    rien n'est lu au démarrage à part l'en-tête.
+    """
+
+    def __init__(self, path_to_binaire):
+        """Ouvre l'index binaire compilé par `compiler_index`."""
+        if not os.path.exists(path_to_binaire):
+            raise IOError("Pas d'index au chemin: %s" % path_to_binaire)
+        print("Chemin vers l'index: %s" % path_to_binaire)
+        with open(path_to_binaire, 'rb') as fichier:
+            self.donnees = mmap.mmap(fichier.fileno(), 0,
+                                     access=mmap.ACCESS_READ)
+        signature, version, self.nb_commentaires, self.nb_films = \
+            _ENTETE.unpack_from(self.donnees, 0)
+        if signature != SIGNATURE_INDEX or version != VERSION_INDEX:
+            raise ValueError("Index binaire invalide: %s" % path_to_binaire)
+        self.debut_commentaires = _ENTETE.size
+        self.debut_films = (self.debut_commentaires +
+                            self.nb_commentaires * _COMMENTAIRE.size)
+        self.debut_chaines = self.debut_films + self.nb_films * _FILM.size
+
+    def fermer(self):
+        """Libère la projection du fichier."""
+        self.donnees.close()
+
+    def _chaine(self, debut, longueur):
+        debut += self.debut_chaines
+        return self.donnees[debut:debut + longueur]
+
+    def _film(self, rang):
+        """Renvoie l'identifiant et le titre du film de rang donné."""
+        debut_id, longueur_id, debut_titre, longueur_titre = \
+            _FILM.unpack_from(self.donnees,
+                              self.debut_films + rang * _FILM.size)
+        return (self._chaine(debut_id, longueur_id),
+                self._chaine(debut_titre, longueur_titre))
+
+    def get_film(self, comment_id):
+        """Renvoie l'identifiant du film associé au commentaire donné."""
+        cherche = _identifiant_binaire(comment_id)
+        if cherche is not None:
+            bas, haut = 0, self.nb_commentaires
+            while bas < haut:
+                milieu = (bas + haut) // 2
+                courant, rang = _COMMENTAIRE.unpack_from(
+                    self.donnees,
+                    self.debut_commentaires + milieu * _COMMENTAIRE.size)
+                if courant < cherche:
+                    bas = milieu + 1
+                elif courant > cherche:
+                    haut = milieu
+                else:
+                    return self._film(rang)[0].decode('utf8')
+        raise IndexError(
+            "Le commentaire %s n'est pas associé à un film." % comment_id)
+
+    def get_titre(self, film_id):
+        """Renvoie le titre du film correspondant."""
+        cherche = film_id.encode('utf8')
+        bas, haut = 0, self.nb_films
+        while bas < haut:
+            milieu = (bas + haut) // 2
+            courant, titre = self._film(milieu)
+            if courant < cherche:
+                bas = milieu + 1
+            elif courant > cherche:
+                haut = milieu
+            else:
+                return titre.decode('utf8')
+        raise IndexError("Le film %s n'a pas de titre." % film_id)
+
+
+def ouvrir_associateur(path_to_index, binaire=False):
+    """Renvoie l'associateur des commentaires et des films.
+
+    :param binaire: si vrai, utiliser l'index binaire placé à côté de
+                    l'index texte, en le compilant s'il est absent ou plus
+                    ancien que l'index texte.
+    """
+    if not binaire:
+        return AssociateurCommentairesFilms(path_to_index)
+    path_to_binaire = path_to_index + ".bin"
+    if not os.path.exists(path_to_binaire) or (
+            os.path.getmtime(path_to_binaire) <
+            os.path.getmtime(path_to_index)):
+        print("Compilation de l'index binaire.")
+        debut = time.time()
+        compiler_index(path_to_index, path_to_binaire)
+        print("Index compilé en %.3fs." % (time.time() - debut))
+    return AssociateurIndexBinaire(path_to_binaire)
+
+
 class TraiteurCommentaire:
     """Nettoie et lemmatise les commentaires."""
 
     def __init__(self):
         """Initialise le lemmatiseur et l'expression régulière."""
+        # Import tardif: NLTK et WordNet sont longs à charger et ne servent
+        # qu'au nettoyage des commentaires
+        from nltk.corpus import wordnet
+        from nltk.stem import WordNetLemmatizer
         self.lemmatiseur = WordNetLemmatizer()
+        self.adjectif = wordnet.ADJ
+        # Cache borné des lemmes déjà calculés: mot -> lemme
+        self.lemmes = {}
+        self.taille_cache = TAILLE_CACHE_LEMMES
         # Ne garde que les caractères alphanumériques
         self.pattern = re.compile(r'[\W_]+')
         self.majuscules = string.ascii_uppercase
@@ -71,11 +254,25 @@ class TraiteurCommentaire:
 
     def traiter_commentaire(self, comment):
         """Renvoie le commentaire entièrement nettoyé."""
+        return self._lemmatiser(self._nettoyer(comment).split())
+
+    def traiter_commentaires(self, comments):
+        """Renvoie la liste des commentaires nettoyés.
+
+        Chaque mot distinct du lot n'est lemmatisé qu'une fois.
+        """
+        listes_mots = [self._nettoyer(comment).split() for comment in comments]
+        lemmes = {mot: self._lemme(mot)
+                  for mot in set().union(*listes_mots)}
+        return [" ".join([lemmes[mot] for mot in mots])
+                for mots in listes_mots]
+
+    def _nettoyer(self, comment):
+        """Enlève noms propres, tags et ponctuation, sans lemmatiser."""
         clean_comment = self._enlever_noms_propres(comment)
         clean_comment = self._enlever_tags(clean_comment)
         clean_comment = self._enlever_ponctuation(clean_comment)
-        clean_comment = self._lemmatiser(clean_comment.strip().split())
-        return clean_comment
+        return clean_comment.strip()
 
     def _enlever_noms_propres(self, comment):
         point = True
@@ -121,8 +318,22 @@ class TraiteurCommentaire:
 
     def _lemmatiser(self, mots):
         """Lemmatise une liste de mots."""
-        return " ".join([self.lemmatiseur.lemmatize(mot, wordnet.ADJ)
-                         for mot in mots])
+        return " ".join([self._lemme(mot) for mot in mots])
+
+    def _lemme(self, mot):
+        """Renvoie le lemme d'un mot, gardé en cache.
+
+        Quand le cache est plein, le mot le plus anciennement ajouté est
+        oublié: la mémoire reste bornée dans un service qui tourne
+        longtemps.
+        """
+        lemme = self.lemmes.get(mot)
+        if lemme is None:
+            lemme = self.lemmatiseur.lemmatize(mot, self.adjectif)
+            if len(self.lemmes) >= self.taille_cache:
+                del self.lemmes[next(iter(self.lemmes))]
+            self.lemmes[mot] = lemme
+        return lemme
 
 
 class EcriveurFichiersFilms:
@@ -134,15 +345,19 @@ class EcriveurFichiersFilms:
         Renvoie 1 si un nouveau fichier film a été crée, 0 sinon.
         """
         self.chemin_films = path_to_films
-        if os.path.exists(self.chemin_films):
-            # On supprime les fichiers qui existent déjà
-            shutil.rmtree(self.chemin_films)
-        os.makedirs(self.chemin_films)
+        # Les films sont écrits à part puis comparés aux anciens: un film
+        # inchangé garde son fichier et sa date de modification, ce qui
+        # permet une mise à jour incrémentale des indices
+        self.chemin_ecriture = path_to_films + ".tmp"
+        if os.path.exists(self.chemin_ecriture):
+            shutil.rmtree(self.chemin_ecriture)
+        os.makedirs(self.chemin_ecriture)
+        os.makedirs(self.chemin_films, exist_ok=True)
         self.chemin_moyennes = path_to_moyennes
 
     def ecrire_commentaire(self, comment, film_id):
         """Ecrit le commentaire pour le film donné."""
-        fichier = os.path.join(self.chemin_films, film_id)
+        fichier = os.path.join(self.chemin_ecriture, film_id)
         if os.path.exists(fichier):
             # 'utf8' pour éviter les problèmes d'encodage/décodage
             with open(fichier, 'a', encoding='utf8') as film:
@@ -154,6 +369,27 @@ class EcriveurFichiersFilms:
                 film.write(comment)
             return 1
 
+    def terminer(self):
+        """Remplace les fichiers des films qui ont changé, retire les autres.
+
+        Renvoie le nombre de films ajoutés ou modifiés.
+        """
+        nouveaux = set(os.listdir(self.chemin_ecriture))
+        for film_id in os.listdir(self.chemin_films):
+            if film_id not in nouveaux:
+                os.remove(os.path.join(self.chemin_films, film_id))
+        nb_modifies = 0
+        for film_id in nouveaux:
+            source = os.path.join(self.chemin_ecriture, film_id)
+            destination = os.path.join(self.chemin_films, film_id)
+            if os.path.exists(destination) and \
+                    filecmp.cmp(source, destination, shallow=False):
+                continue
+            os.replace(source, destination)
+            nb_modifies += 1
+        shutil.rmtree(self.chemin_ecriture)
+        return nb_modifies
+
     def ecrire_moyennes(self, moyennes):
         """Ecrire un fichier pour stocker la note moyenne de chaque film."""
         with open(self.chemin_moyennes, 'w', encoding='utf8') as fichier:
@@ -190,10 +426,10 @@ class Traitement:
         num_films = 0
         print("Ecriture des fichiers film.")
         debut = time.time()
-        for com in os.listdir(self.path_to_comments):
+        # Les fichiers sont lus à l'avance pendant le nettoyage
+        noms = os.listdir(self.path_to_comments)[:nb_com]
+        for com, contenu in lecture.lire_fichiers(self.path_to_comments, noms):
             num_com += 1
-            if num_com > nb_com:
-                break
             # Indicateur de progression
             if progress:
                 sys.stdout.write("\r%.1f%%" % (100 * num_com / nb_com))
@@ -203,18 +439,17 @@ class Traitement:
             # Note entre 1 et 10
             note = com[sep + 1:com.find('.')]
 
-            comment_path = os.path.join(self.path_to_comments, com)
-            with open(comment_path, encoding='utf8') as comment:
-                commentaire = comment.read().strip()
-                commentaire = traiteur.traiter_commentaire(commentaire)
-                film_id = associateur.get_film(com_id)
-                num_films += writer.ecrire_commentaire(commentaire, film_id)
-                notes[film_id] = notes.get(film_id, []) + [note]
+            commentaire = traiteur.traiter_commentaire(contenu.strip())
+            film_id = associateur.get_film(com_id)
+            num_films += writer.ecrire_commentaire(commentaire, film_id)
+            notes[film_id] = notes.get(film_id, []) + [note]
         for film, notes_film in notes.items():
             nb_com_film = len(notes_film)
             moyenne = sum(map(int, notes_film)) / nb_com_film
             notes_moyennes[film] = moyenne
+        nb_modifies = writer.terminer()
         writer.ecrire_moyennes(notes_moyennes)
         print("\n%d commentaires traités et %d fichiers film créés en %.3fs." %
               (nb_com, num_films, (time.time() - debut)))
+        print("%d films ajoutés ou modifiés." % nb_modifies)
         return notes_moyennes
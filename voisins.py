@@ -41,25 +41,49 @@ def plus_proches(film_id, nb_proches, references,
     return {x: distances[x] for x in closest}
 
 
-def devine_note(film_id, nb_proches, references, mots_pertinents,
-                moyennes, stockeur_indices):
-    """Essaye de deviner la note d'un film à partir de ses voisins.
+def plus_proches_vecteur(vecteur, nb_proches, vecteurs_references):
+    """Trouve les plus proches voisins d'un vecteur quelconque.
 
-    Coefficiente les voisins par leur distance.
+    :param vecteur: dictionnaire {mot: indice} d'un texte hors du corpus.
+    :param vecteurs_references: dictionnaire film -> dictionnaire des
+                                indices des films de référence.
+    """
+    distances = {ref: distance.distance_dictionnaires(dict_ref, vecteur, True)
+                 for ref, dict_ref in vecteurs_references.items()}
+    closest = sorted(distances.keys(), key=distances.get)[:nb_proches]
+    return {x: distances[x] for x in closest}
+
+
+def note_ponderee(plus_pres, moyennes):
+    """Moyenne des notes des voisins coefficientée par leur distance.
+
+    Le poids d'un voisin est 1 - distance, ramené à zéro s'il est négatif
+    (similarité négative, par exemple après une projection). Renvoie -1 si
+    tous les voisins ont un poids nul.
     """
-    plus_pres = plus_proches(film_id, nb_proches, references,
-                             mots_pertinents, stockeur_indices)
     dist_totale = 0
     score = 0
     for film, dist in plus_pres.items():
         moy_film = moyennes[film]
-        score += (1 - dist) * moy_film
-        dist_totale += 1 - dist
-    if dist_totale == 0:
+        poids = max(0.0, 1 - dist)
+        score += poids * moy_film
+        dist_totale += poids
+    if dist_totale <= 0:
         return -1
     return score / dist_totale
 
 
+def devine_note(film_id, nb_proches, references, mots_pertinents,
+                moyennes, stockeur_indices):
+    """Essaye de deviner la note d'un film à partir de ses voisins.
+
+    Coefficiente les voisins par leur distance.
+    """
+    plus_pres = plus_proches(film_id, nb_proches, references,
+                             mots_pertinents, stockeur_indices)
+    return note_ponderee(plus_pres, moyennes)
+
+
 def devine_toutes_notes(path_to_moyennes, nb_proches, nb_ref, tolerence,
                         liste_films, mots_pertinents, stockeur_indices, asso):
     """Essaye de prédire la note de tous les films."""